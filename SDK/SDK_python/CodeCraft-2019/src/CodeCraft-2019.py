@@ -1,3 +1,4 @@
+import argparse
 import os
 import logging
 import sys
@@ -6,11 +7,8 @@ from time import time
 import matplotlib.pyplot as plt
 
 import networkx as nx
-from utc.car import Car
-from utc.cross import Cross
-from utc.road import Road
+from utc.loader import load_map, write_answer
 from utc.scheduler import Scheduler
-from utc.util import strip_parenthesis, read_file_and_yield_info
 
 
 logging.basicConfig(level=logging.DEBUG,
@@ -23,56 +21,32 @@ stdout_handler = logging.StreamHandler(sys.stdout)
 logger.addHandler(stdout_handler)
 
 
-def read_cars(car_path):
-    cars_info = read_file_and_yield_info(car_path)
-    cars = [
-        Car(car_id=car[0], start_cross_id=car[1], end_cross_id=car[2],
-            highest_speed=car[3], planned_departure_time=car[4])
-        for car in cars_info
-    ]
-    return cars
-
-def read_crosses(cross_path):
-    crosses_info = read_file_and_yield_info(cross_path)
-    crosses = [
-        Cross(cross_id=cross[0], connected_roads=cross[1:])
-        for cross in crosses_info
-    ]
-    return sorted(crosses, key=lambda cross: int(cross.cross_id))
-
-def read_roads(road_path):
-    roads_info = read_file_and_yield_info(road_path)
-    roads = []
-    for road in roads_info:
-        if road[6] == '1':
-            roads.extend([
-                Road(road_id=road[0]+'#1', length=road[1], highest_speed=road[2], num_lane=road[3], start_cross_id=road[4], end_cross_id=road[5]),
-                Road(road_id=road[0]+'#2', length=road[1], highest_speed=road[2], num_lane=road[3], start_cross_id=road[5], end_cross_id=road[4])
-            ])
-        else:
-            roads.append(Road(road_id=road[0]+'#1', length=road[1], highest_speed=road[2], num_lane=road[3], start_cross_id=road[4], end_cross_id=road[5]))
-    return sorted(roads,
-                  key=lambda road: int(road.road_id[:road.road_id.find('#')])
-                                   or int(road.road_id[road.road_id.find('#')+1:]))
-
-
-def write_answer(answer_path, cars):
-    with open(answer_path, 'w') as fout:
-        for car in cars:
-            answer = [car.car_id] + [str(car.departure_time)] + [road_id[:road_id.find('#')] for road_id in car.passed_roads]
-            answer = '(' + ', '.join(answer) + ')\n'
-            fout.write(answer)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('car_path')
+    parser.add_argument('road_path')
+    parser.add_argument('cross_path')
+    parser.add_argument('answer_path')
+    parser.add_argument('--checkpoint-dir', default=None,
+                        help='每隔 --checkpoint-interval 个时间片在该目录写一个检查点')
+    parser.add_argument('--checkpoint-interval', type=int, default=100)
+    parser.add_argument('--resume', default=None, help='从该检查点继续调度')
+    parser.add_argument('--map-cache', default=None,
+                        help='编译好的地图的缓存目录, 地图文件不变时直接内存映射, 不再解析')
+    parser.add_argument('--time-limit', type=float, default=None,
+                        help='程序总的运行时间上限 (秒), 临近时调度逐级降级, 保证按时写出答案')
+    parser.add_argument('--route-table-interval', type=int, default=None,
+                        help='用全源最短路表规划路线, 后台每隔这么多个时间片整表重算 (0 为只做增量修补)')
+    parser.add_argument('--draw', action='store_true', help='写完答案后把路网画到 directed_graph.png')
+    return parser.parse_args()
 
 
 def main():
-    if len(sys.argv) != 5:
-        logger.error('please input args: car_path, road_path, cross_path, answerPath')
-        exit(1)
-
-    car_path = sys.argv[1]
-    road_path = sys.argv[2]
-    cross_path = sys.argv[3]
-    answer_path = sys.argv[4]
+    args = parse_args()
+    car_path = args.car_path
+    road_path = args.road_path
+    cross_path = args.cross_path
+    answer_path = args.answer_path
 
     logger.info("car_path is %s" % (car_path))
     logger.info("road_path is %s" % (road_path))
@@ -80,24 +54,31 @@ def main():
     logger.info("answer_path is %s" % (answer_path))
 
     program_start_time = time()
-    cars = read_cars(car_path)
-    # for car in cars:
-    #     logger.info(car.__dict__)
-    crosses = read_crosses(cross_path)
-    # for cross in crosses:
-    #     logger.info(cross.__dict__)
-    roads = read_roads(road_path)
-    # for road in roads:
-    #     logger.info(road.__dict__)
-    #     for lane in road.lanes:
-    #         logger.info(lane.__dict__)
+    # 留出写答案的时间; 读地图与构造调度器 (规划全部车辆的路线) 都计入预算
+    deadline = program_start_time + 0.95 * args.time_limit if args.time_limit else None
+    # 官方 id 到内部编号的映射, 调度器内部只使用内部编号; 三个文件整体读入后以数组构造
+    cars, crosses, roads, car_indexer, road_indexer = load_map(car_path, road_path, cross_path,
+                                                               cache_dir=args.map_cache)
     # logger.info(cross_indexer)
     # logger.info(road_indexer)
-    scheduler = Scheduler(crosses, roads, cars, capacity_threshold=0.5, num_cars_on_road=1024)
-    nx.draw(scheduler.roadnet)
-
+    scheduler = Scheduler(crosses, roads, cars, capacity_threshold=0.5, num_cars_on_road=1024,
+                          deadline=deadline, route_table_interval=args.route_table_interval)
+    if args.resume:
+        scheduler.load_checkpoint(args.resume)
+        logger.info('从检查点 {} 继续, 第{}个时间片'.format(args.resume, scheduler.current_time))
+    if args.checkpoint_dir:
+        os.makedirs(args.checkpoint_dir, exist_ok=True)
+
+    # 空闲时段会被整段跳过, 按距上一个检查点的时间片数而不是整除判断; 刚载入的检查点不必重写
+    last_checkpoint_time = scheduler.current_time
     while scheduler.cars_to_run or scheduler.running_cars:
+        if args.checkpoint_dir and scheduler.current_time >= last_checkpoint_time + args.checkpoint_interval:
+            scheduler.save_checkpoint(os.path.join(
+                args.checkpoint_dir, 'checkpoint_{}.pkl'.format(scheduler.current_time)))
+            last_checkpoint_time = scheduler.current_time
         scheduler.schedule()
+    scheduler.close()
+    logger.info('路线缓存命中率: {:.1%}'.format(scheduler.route_cache.hit_rate()))
     # for car in scheduler.cars_to_start:
     #     logger.info(car.__dict__)
 
@@ -109,10 +90,13 @@ def main():
     # print(len(roadnet._vertexes))
     # print('Edges', roadnet._edges)
 
-    plt.savefig('directed_graph.png')
+    # 先写答案, 画图再慢也不影响按时交卷
+    write_answer(answer_path, cars, car_indexer, road_indexer)
+    if args.draw:
+        nx.draw(scheduler.roadnet)
+        plt.savefig('directed_graph.png')
     program_running_time = time() - program_start_time
     logger.info('Total time: {}'.format(program_running_time))
-    write_answer(answer_path, cars)
 
 
 
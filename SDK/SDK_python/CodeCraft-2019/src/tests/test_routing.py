@@ -0,0 +1,198 @@
+import random
+import unittest
+from collections import defaultdict
+
+import numpy as np
+
+import networkx as nx
+
+from utc.routing import TREE_TOLERANCE, DestinationTrees, RouteCache, RouteTable, all_pairs_shortest_paths
+
+
+def make_grid_roadnet(size, seed=0):
+    """size*size 的网格路网, 相邻路口间双向连边, 路口编号为 0..size*size-1, 路权随机"""
+    rng = random.Random(seed)
+    roadnet = nx.DiGraph()
+    roadnet.add_nodes_from(range(size*size))
+    for r in range(size):
+        for c in range(size):
+            for nr, nc in ((r, c+1), (r+1, c)):
+                if nr < size and nc < size:
+                    u, v = r*size + c, nr*size + nc
+                    roadnet.add_edge(u, v, weight=rng.uniform(1, 4))
+                    roadnet.add_edge(v, u, weight=rng.uniform(1, 4))
+    return roadnet
+
+
+def change_weights(roadnet, shortest_paths, rng, num_edges):
+    """随机挑 num_edges 条道路改变路权, 同调度器一样先通知 shortest_paths 再改 roadnet"""
+    for s, e in rng.sample(list(roadnet.edges()), num_edges):
+        old_weight = roadnet[s][e]['weight']
+        new_weight = old_weight * rng.uniform(0.3, 3)
+        shortest_paths.on_weight_change(s, e, old_weight, new_weight)
+        roadnet[s][e]['weight'] = new_weight
+
+
+def set_weight(roadnet, shortest_paths, start_cross_id, end_cross_id, new_weight):
+    old_weight = roadnet[start_cross_id][end_cross_id]['weight']
+    shortest_paths.on_weight_change(start_cross_id, end_cross_id, old_weight, new_weight)
+    roadnet[start_cross_id][end_cross_id]['weight'] = new_weight
+
+
+class DestinationTreesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.roadnet = make_grid_roadnet(4)
+        self.trees = DestinationTrees(self.roadnet)
+        self.weight = self.roadnet[0][1]['weight']
+
+    def test_tree_is_invalidated_past_tolerance(self):
+        self.trees.get_tree(15)
+        set_weight(self.roadnet, self.trees, 0, 1, self.weight * (1 + TREE_TOLERANCE / 2))
+        self.assertIn(15, self.trees.trees)
+        set_weight(self.roadnet, self.trees, 0, 1, self.weight * (1 + TREE_TOLERANCE * 1.5))
+        self.assertNotIn(15, self.trees.trees)
+
+    def test_drift_is_measured_against_every_tree(self):
+        # 树 15 按原来的权建, 树 14 按变慢后的权建; 再变快时与树 15 相比在容差以内, 与树 14 相比已超出
+        self.trees.get_tree(15)
+        set_weight(self.roadnet, self.trees, 0, 1, self.weight * (1 + TREE_TOLERANCE * 0.75))
+        self.trees.get_tree(14)
+        self.assertEqual(set(self.trees.trees), {14, 15})
+        set_weight(self.roadnet, self.trees, 0, 1, self.weight * (1 - TREE_TOLERANCE * 0.75))
+        self.assertFalse(self.trees.trees)
+
+    def test_rebuilt_tree_uses_current_weights(self):
+        self.trees.get_tree(15)
+        for s, e in list(self.roadnet.edges()):
+            set_weight(self.roadnet, self.trees, s, e, self.roadnet[s][e]['weight'] * 3)
+        times = nx.single_source_dijkstra_path_length(self.roadnet.reverse(copy=False), 15, weight='weight')
+        for cross_id, path_time in times.items():
+            self.assertAlmostEqual(self.trees.get_time(cross_id, 15), path_time)
+
+
+class FirstHopsTestCase(unittest.TestCase):
+    def setUp(self):
+        # 从路口 0 到终点 3: 相邻路口 1 的最短路线 1->4->0->3 绕回起点, 不是合法的第一步
+        self.roadnet = nx.DiGraph()
+        self.roadnet.add_nodes_from(range(5))
+        self.roadnet.add_weighted_edges_from([
+            (0, 1, 1.0), (1, 4, 0.5), (4, 0, 0.5), (1, 3, 10.0),
+            (0, 2, 1.0), (2, 3, 5.0),
+            (0, 3, 1.0),
+        ])
+
+    def assert_first_hops(self, shortest_paths):
+        hops = dict(shortest_paths.get_first_hops(0, 3))
+        self.assertEqual(sorted(hops), [2, 3])
+        self.assertAlmostEqual(hops[2], 6.0)
+        self.assertAlmostEqual(hops[3], 1.0)
+
+    def test_destination_trees_exclude_hops_back_through_start(self):
+        self.assert_first_hops(DestinationTrees(self.roadnet))
+
+    def test_route_table_excludes_hops_back_through_start(self):
+        self.assert_first_hops(RouteTable(self.roadnet))
+
+
+class RouteCacheTestCase(unittest.TestCase):
+    key = (0, 5, None)
+    path = [0, 1, 2, 5]
+
+    def setUp(self):
+        # 3*3 的网格, 路口 0 1 2 / 3 4 5 / 6 7 8
+        self.roadnet = make_grid_roadnet(3)
+        self.cache = RouteCache()
+        self.epoch = 0
+        self.edge_versions = defaultdict(int)
+        self.path_time = self.get_path_time()
+        self.cache.put(self.key, list(self.path), self.path_time, self.epoch, self.edge_versions)
+
+    def get_path_time(self):
+        return sum(self.roadnet[s][e]['weight'] for s, e in zip(self.path[:-1], self.path[1:]))
+
+    def change_weight(self, start_cross_id, end_cross_id, factor):
+        """同调度器一样改变路权并更新版本"""
+        self.roadnet[start_cross_id][end_cross_id]['weight'] *= factor
+        self.epoch += 1
+        self.edge_versions[(start_cross_id, end_cross_id)] += 1
+
+    def get(self, avoid=()):
+        return self.cache.get(self.key, self.roadnet, self.epoch, self.edge_versions, avoid)
+
+    def test_route_is_reused_while_its_roads_do_not_change(self):
+        self.assertEqual(self.get(), (self.path, self.path_time))
+        self.change_weight(3, 4, 2)  # 路线以外的道路
+        self.assertEqual(self.get(), (self.path, self.path_time))
+
+    def test_route_is_dropped_when_its_time_grows(self):
+        self.change_weight(1, 2, 1.5)
+        self.assertIsNone(self.get())
+        self.assertNotIn(self.key, self.cache.entries)
+
+    def test_route_is_reused_when_its_time_shrinks(self):
+        self.change_weight(1, 2, 0.5)
+        path, path_time = self.get()
+        self.assertEqual(path, self.path)
+        self.assertAlmostEqual(path_time, self.get_path_time())
+
+    def test_route_through_avoided_cross_is_rejected(self):
+        self.assertIsNotNone(self.get(avoid=[0, 3]))  # 起点本身不算经过
+        self.assertIsNone(self.get(avoid=[3, 2]))
+        self.assertNotIn(self.key, self.cache.entries)
+
+
+class RouteTableTestCase(unittest.TestCase):
+    size = 5
+
+    def setUp(self):
+        self.roadnet = make_grid_roadnet(self.size)
+        self.rng = random.Random(1)
+
+    def test_repaired_times_match_all_pairs_shortest_paths(self):
+        # 容差为 0, 修补数与行数不设限时, 每次修补后的表应与按表所用的权整表重算的结果一致
+        num_crosses = self.roadnet.number_of_nodes()
+        table = RouteTable(self.roadnet, tolerance=0.0,
+                           max_repairs=self.roadnet.number_of_edges(), max_rows=num_crosses)
+        for t in range(30):
+            change_weights(self.roadnet, table, self.rng, 5)
+            table.on_tick(t)
+            np.testing.assert_array_equal(table.table_weights, table.live_weights)
+            times, _ = all_pairs_shortest_paths(table.table_weights)
+            np.testing.assert_allclose(table.times, times, err_msg='第{}轮修补后的耗时不同'.format(t))
+            for start_cross_id, end_cross_id in ((0, num_crosses-1), (num_crosses-1, 0)):
+                path = table.get_path(start_cross_id, end_cross_id)
+                path_time = sum(table.table_weights[s, e] for s, e in zip(path[:-1], path[1:]))
+                self.assertAlmostEqual(path_time, times[start_cross_id, end_cross_id])
+
+    def test_snapshot_is_not_changed_by_later_repairs(self):
+        table = RouteTable(self.roadnet, interval=2, tolerance=0.0)
+        try:
+            change_weights(self.roadnet, table, self.rng, 5)
+            table.on_tick(0)
+            submitted_weights = table.recompute_weights.copy()
+            snapshot = table.snapshot()
+            # 换表后后台所用的权成为 table_weights, 随后的修补会改写它
+            for t in range(1, 5):
+                change_weights(self.roadnet, table, self.rng, 5)
+                table.on_tick(t)
+            table.restore(snapshot)
+            np.testing.assert_array_equal(table.recompute_weights, submitted_weights)
+        finally:
+            table.close()
+
+    def test_restore_after_close(self):
+        table = RouteTable(self.roadnet, interval=2)
+        table.on_tick(0)
+        snapshot = table.snapshot()
+        table.close()
+        table.restore(snapshot)
+        try:
+            table.on_tick(2)
+            times, _ = all_pairs_shortest_paths(table.table_weights)
+            np.testing.assert_allclose(table.times, times)
+        finally:
+            table.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from utc.loader import load_map, write_answer
+from utc.replay import replay, score_answers
+from utc.scheduler import Scheduler
+
+
+def write_grid_map(map_dir, size, num_cars, seed=0):
+    """在 map_dir 下写一张 size*size 的网格地图 (双向道路) 与 num_cars 辆随机起终点的车辆, 格式同官方数据"""
+    rng = random.Random(seed)
+    cross_id = lambda r, c: r*size + c + 1
+    roads = []
+    horizontal, vertical = {}, {}
+    for r in range(size):
+        for c in range(size):
+            for neighbour, table in (((r, c+1), horizontal), ((r+1, c), vertical)):
+                if neighbour[0] < size and neighbour[1] < size:
+                    road_id = 5000 + len(roads)
+                    table[(r, c)] = road_id
+                    roads.append((road_id, rng.randint(6, 14), rng.randint(4, 8), rng.randint(1, 3),
+                                  cross_id(r, c), cross_id(*neighbour), 1))
+
+    with open(os.path.join(map_dir, 'road.txt'), 'w') as fout:
+        fout.write('#(id,length,speed,channel,from,to,isDuplex)\n')
+        for road in roads:
+            fout.write('({})\n'.format(', '.join(map(str, road))))
+    with open(os.path.join(map_dir, 'cross.txt'), 'w') as fout:
+        fout.write('#(id,roadId,roadId,roadId,roadId)\n')
+        for r in range(size):
+            for c in range(size):
+                # 顺时针: 上, 右, 下, 左
+                fout.write('({}, {}, {}, {}, {})\n'.format(
+                    cross_id(r, c), vertical.get((r-1, c), -1), horizontal.get((r, c), -1),
+                    vertical.get((r, c), -1), horizontal.get((r, c-1), -1)))
+    with open(os.path.join(map_dir, 'car.txt'), 'w') as fout:
+        fout.write('#(id,from,to,speed,planTime)\n')
+        for i in range(num_cars):
+            start, end = rng.sample(range(1, size*size+1), 2)
+            fout.write('({}, {}, {}, {}, {})\n'.format(10000+i, start, end, rng.choice([4, 6, 8]), rng.randint(1, 10)))
+
+
+def lane_positions(scheduler):
+    """每条车道上 (位置, 车辆) 的列表, 用于逐时间片比较路况"""
+    return {
+        (road_id, lane.lane_id): [(pos, lane.positions[pos].car_id) for pos in lane.positions.occupied]
+        for road_id, road in scheduler.roads.items()
+        for lane in road.lanes
+    }
+
+
+def answer_of(scheduler):
+    """每辆车的 (car_id, 出发时间, 经过的道路), 即写出的答案"""
+    return [(car.car_id, int(car.departure_time), car.passed_roads.tolist()) for car in scheduler.fleet]
+
+
+class SchedulerTestCase(unittest.TestCase):
+    size = 4
+    num_cars = 300
+    max_time = 1000
+
+    def setUp(self):
+        self.map_dir = tempfile.mkdtemp()
+        write_grid_map(self.map_dir, self.size, self.num_cars)
+        self.paths = [os.path.join(self.map_dir, name) for name in ('car.txt', 'road.txt', 'cross.txt')]
+
+    def tearDown(self):
+        shutil.rmtree(self.map_dir, ignore_errors=True)
+
+    def make_scheduler(self, cache_dir=None, **kwargs):
+        """固定随机种子构造调度器, 返回调度器与地图的编号表"""
+        random.seed(0)
+        np.random.seed(0)
+        cars, crosses, roads, car_indexer, road_indexer = load_map(*self.paths, cache_dir=cache_dir)
+        scheduler = Scheduler(crosses, roads, cars, capacity_threshold=0.5, num_cars_on_road=64, **kwargs)
+        return scheduler, car_indexer, road_indexer
+
+    def run_to_end(self, scheduler, history=None):
+        """调度到所有车辆结束, history 不为 None 时记下每个时间片结束时的路况"""
+        while (scheduler.cars_to_run or scheduler.running_cars) and scheduler.current_time < self.max_time:
+            scheduler.schedule()
+            if history is not None:
+                history.append(lane_positions(scheduler))
+
+    def run_scheduler(self, **kwargs):
+        """固定随机种子调度到所有车辆结束, 返回调度器, 地图的编号表与每个时间片结束时的路况"""
+        scheduler, car_indexer, road_indexer = self.make_scheduler(**kwargs)
+        history = []
+        self.run_to_end(scheduler, history)
+        scheduler.close()
+        return scheduler, car_indexer, road_indexer, history
+
+    def assert_rerun_after_restore_is_identical(self, **kwargs):
+        """调度几个时间片后快照, 调度到结束, 再两次回滚到快照重新调度, 答案应完全一致"""
+        scheduler = self.make_scheduler(**kwargs)[0]
+        try:
+            for _ in range(5):
+                scheduler.schedule()
+            snapshot = scheduler.snapshot()
+            self.run_to_end(scheduler)
+            expected = answer_of(scheduler)
+            for _ in range(2):
+                scheduler.restore(snapshot)
+                self.run_to_end(scheduler)
+                self.assertEqual(answer_of(scheduler), expected)
+        finally:
+            scheduler.close()
+
+    def test_vectorized_phase1_matches_per_car_phase1(self):
+        _, _, _, vectorized = self.run_scheduler(vectorized_phase1=True)
+        _, _, _, per_car = self.run_scheduler(vectorized_phase1=False)
+        self.assertEqual(len(vectorized), len(per_car))
+        for t, (expected, actual) in enumerate(zip(per_car, vectorized)):
+            self.assertEqual(expected, actual, '第{}个时间片的路况不同'.format(t+1))
+
+    def test_scheduler_answer_replays_without_deadlock(self):
+        # 调度器的模拟与官方规则并不逐车一致, 只要求其答案合法且按官方规则回放不死锁
+        scheduler, car_indexer, road_indexer, _ = self.run_scheduler()
+        self.assertFalse(scheduler.cars_to_run or scheduler.running_cars)
+        answer_path = os.path.join(self.map_dir, 'answer.txt')
+        write_answer(answer_path, scheduler.fleet, car_indexer, road_indexer)
+
+        result = replay(*self.paths, answer_path=answer_path)
+        self.assertFalse(result.deadlock)
+        self.assertEqual(result.num_arrived, self.num_cars)
+
+    def assert_resume_from_checkpoint_is_identical(self, **kwargs):
+        """调度中途写检查点后调度到结束, 另一个新构造的调度器从检查点恢复后调度到结束, 答案应完全一致"""
+        checkpoint_path = os.path.join(self.map_dir, 'checkpoint.pkl')
+        scheduler = self.make_scheduler(**kwargs)[0]
+        try:
+            for _ in range(10):
+                scheduler.schedule()
+            scheduler.save_checkpoint(checkpoint_path)
+            checkpoint_time = scheduler.current_time
+            self.run_to_end(scheduler)
+            expected = answer_of(scheduler)
+        finally:
+            scheduler.close()
+
+        resumed = self.make_scheduler(**kwargs)[0]
+        try:
+            resumed.load_checkpoint(checkpoint_path)
+            self.assertEqual(resumed.current_time, checkpoint_time)
+            self.run_to_end(resumed)
+            self.assertEqual(answer_of(resumed), expected)
+        finally:
+            resumed.close()
+
+    def test_map_cache_gives_identical_answer(self):
+        # 第二次从缓存内存映射编译结果, 路口的转向表与路网的邻接表都直接读自映射的数组
+        cache_dir = os.path.join(self.map_dir, 'cache')
+        answers = []
+        for map_cache in (None, cache_dir, cache_dir):
+            scheduler = self.make_scheduler(cache_dir=map_cache)[0]
+            self.run_to_end(scheduler)
+            scheduler.close()
+            answers.append(answer_of(scheduler))
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(answers[1], answers[0])
+        self.assertEqual(answers[2], answers[0])
+
+    def test_rerun_after_restore_is_identical(self):
+        self.assert_rerun_after_restore_is_identical()
+
+    def test_route_table_rerun_after_restore_is_identical(self):
+        # 后台重算的权在换表后被修补改写, 快照若不拷贝就会回滚到改写后的权; 小地图上路权变化少, 看不出差别
+        write_grid_map(self.map_dir, 6, 800)
+        self.assert_rerun_after_restore_is_identical(route_table_interval=10)
+
+    def test_resume_from_checkpoint_is_identical(self):
+        self.assert_resume_from_checkpoint_is_identical()
+
+    def test_route_table_resume_from_checkpoint_is_identical(self):
+        self.assert_resume_from_checkpoint_is_identical(route_table_interval=10)
+
+
+class ReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.map_dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.map_dir, name) for name in ('car.txt', 'road.txt', 'cross.txt')]
+
+    def tearDown(self):
+        shutil.rmtree(self.map_dir, ignore_errors=True)
+
+    def write(self, name, lines):
+        path = os.path.join(self.map_dir, name)
+        with open(path, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        return path
+
+    def write_single_road(self, cars):
+        """一条长 10, 限速 5, 单车道的道路连接路口 1 与 2"""
+        self.write('road.txt', ['#(id,length,speed,channel,from,to,isDuplex)', '(5000, 10, 5, 1, 1, 2, 1)'])
+        self.write('cross.txt', ['#(id,roadId,roadId,roadId,roadId)',
+                                 '(1, -1, 5000, -1, -1)', '(2, -1, -1, -1, 5000)'])
+        self.write('car.txt', ['#(id,from,to,speed,planTime)'] + cars)
+
+    def test_single_car_on_single_road(self):
+        # 车速 5: 第 1 个时间片上路开到 5, 第 2 个开到 10, 第 3 个驶出道路到达终点
+        self.write_single_road(['(10000, 1, 2, 5, 1)'])
+        answer_path = self.write('answer.txt', ['(10000, 1, 5000)'])
+
+        result = replay(*self.paths, answer_path=answer_path)
+        self.assertFalse(result.deadlock)
+        self.assertEqual(result.num_arrived, 1)
+        self.assertEqual(result.schedule_time, 3)
+        self.assertEqual(result.total_time, 2)
+
+    def test_fast_car_follows_slow_car(self):
+        # 慢车 (车速 2) 先上路停在 2, 快车只能跟在其后停在 1, 此后一直被挡住;
+        # 第 6 个时间片慢车驶出道路, 快车在同一时间片的路口调度中随之驶出
+        self.write_single_road(['(10000, 1, 2, 2, 1)', '(10001, 1, 2, 5, 1)'])
+        answer_path = self.write('answer.txt', ['(10000, 1, 5000)', '(10001, 1, 5000)'])
+
+        result = replay(*self.paths, answer_path=answer_path)
+        self.assertFalse(result.deadlock)
+        self.assertEqual(result.num_arrived, 2)
+        self.assertEqual(result.schedule_time, 6)
+        self.assertEqual(result.total_time, 10)
+
+    def test_early_departure_is_rejected(self):
+        self.write_single_road(['(10000, 1, 2, 5, 3)'])
+        answer_path = self.write('answer.txt', ['(10000, 1, 5000)'])
+        with self.assertRaises(RuntimeError):
+            replay(*self.paths, answer_path=answer_path)
+
+    def test_score_answers_records_invalid_answers(self):
+        self.write_single_road(['(10000, 1, 2, 5, 1)'])
+        answer_paths = [
+            self.write('valid.txt', ['(10000, 1, 5000)']),
+            self.write('unknown_road.txt', ['(10000, 1, 5001)']),
+            self.write('unknown_car.txt', ['(10001, 1, 5000)']),
+            self.write('malformed.txt', ['(10000, x, 5000)']),
+        ]
+        scores = score_answers(*self.paths, answer_paths=answer_paths, num_workers=1)
+        self.assertEqual([answer_path for answer_path, _, _ in scores], answer_paths)
+        self.assertEqual(scores[0][1].schedule_time, 3)
+        self.assertIsNone(scores[0][2])
+        for _, result, error in scores[1:]:
+            self.assertIsNone(result)
+            self.assertTrue(error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utc import sweep as sweep_module
+from utc.sweep import make_configs, run_config, sweep
+
+from tests.test_scheduler import write_grid_map
+
+
+class SweepTestCase(unittest.TestCase):
+    def setUp(self):
+        self.map_dir = tempfile.mkdtemp()
+        write_grid_map(self.map_dir, 4, 300)
+        self.paths = tuple(os.path.join(self.map_dir, name) for name in ('car.txt', 'road.txt', 'cross.txt'))
+        self.out_dir = os.path.join(self.map_dir, 'sweep')
+
+    def tearDown(self):
+        shutil.rmtree(self.map_dir, ignore_errors=True)
+
+    def test_results_are_ranked_by_replay(self):
+        configs = make_configs({'capacity_threshold': [0.3, 0.5, 0.7], 'num_cars_on_road': [64]})
+        results = sweep(self.paths, configs, self.out_dir, num_workers=1)
+        self.assertEqual(len(results), len(configs))
+
+        finished = [r for r in results if r[2] == 'finished']
+        self.assertTrue(finished)
+        self.assertEqual(results[:len(finished)], finished)
+        scores = [(result.schedule_time, result.total_time) for _, _, _, _, _, result in finished]
+        self.assertEqual(scores, sorted(scores))
+        for _, _, _, _, answer_path, result in finished:
+            self.assertFalse(result.deadlock)
+            self.assertTrue(os.path.exists(answer_path))
+
+    def test_sweep_does_not_leave_a_bound_behind(self):
+        configs = make_configs({'capacity_threshold': [0.5], 'num_cars_on_road': [64]})
+        best = sweep(self.paths, configs, self.out_dir, num_workers=1)[0]
+        self.assertEqual(best[2], 'finished')
+        self.assertIsNone(sweep_module._best_ticks)
+
+        # 单独调用 run_config 不受之前 sweep 的剪枝界限影响
+        status, _ = run_config(self.paths, configs[0], os.path.join(self.out_dir, 'again.txt'))
+        self.assertEqual(status, 'finished')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,39 +3,119 @@ CAR_RUNNING = 1
 CAR_STOP = 2
 CAR_END = 3
 
+# 过路口的方式, 在 utc.fleet.Fleet 中以下标存储, 0 表示尚未决定
+PASS_WAYS = (None, 'go_straight', 'turn_left', 'turn_right')
+PASS_WAY2CODE = {pass_way: code for code, pass_way in enumerate(PASS_WAYS)}
+
+
+def _fleet_field(name, none_value=None):
+    """将车辆的一个属性映射到 Fleet 中同名数组的第 car_id 个元素, none_value 表示 None"""
+    def fget(self):
+        value = getattr(self.fleet, name)[self.car_id]
+        if none_value is not None and value == none_value:
+            return None
+        return value.item()
+
+    def fset(self, value):
+        getattr(self.fleet, name)[self.car_id] = none_value if value is None else value
+
+    return property(fget, fset)
 
 
 class Car(object):
-    def __init__(self, car_id, start_cross_id, end_cross_id,
-                 highest_speed, planned_departure_time):
+    """车辆的视图, 车辆的状态都保存在 utc.fleet.Fleet 的数组中.
+
+    保留原先的属性访问方式, 调度器不必关心状态的实际存储.
+    车辆与路口均使用内部编号 (见 utc.indexer), 不是官方 id.
+    """
+    __slots__ = ('fleet', 'car_id')
+
+    def __init__(self, fleet, car_id):
         super(Car, self).__init__()
+        self.fleet = fleet
+        self.car_id = car_id
+
+    start_cross_id = _fleet_field('start_cross_id')
+    end_cross_id = _fleet_field('end_cross_id')
+    highest_speed = _fleet_field('highest_speed')
+    planned_departure_time = _fleet_field('planned_departure_time')
+    current_speed = _fleet_field('current_speed')
+
+    ideal_time = _fleet_field('ideal_time', none_value=-1)
+    ideal_arrival_time = _fleet_field('ideal_arrival_time', none_value=-1)
+
+    departure_time = _fleet_field('departure_time', none_value=-1)
+    on_position = _fleet_field('on_position', none_value=-1)  # road position on lane
+
+    @property
+    def state(self):
+        state = self.fleet.state[self.car_id]
+        return None if state == 0 else state.item()
+
+    @state.setter
+    def state(self, state):
+        fleet = self.fleet
+        if fleet.state_listener is not None and state != self.state:
+            fleet.state_listener(self, state)
+        fleet.state[self.car_id] = 0 if state is None else state
+
+    @property
+    def ideal_path(self):
+        return self.fleet.ideal_paths[self.car_id]
+
+    @ideal_path.setter
+    def ideal_path(self, path):
+        self.fleet.ideal_paths[self.car_id] = path
+
+    @property
+    def passed_roads(self):
+        """有向道路的编号"""
+        return self.fleet.get_route(self.car_id)[0]
+
+    @property
+    def passed_crosses(self):
+        return self.fleet.get_route(self.car_id)[1]
+
+    @property
+    def on_road(self):
+        """road object"""
+        road_id = self.fleet.on_road[self.car_id]
+        return None if road_id == -1 else self.fleet.roads[road_id]
+
+    @on_road.setter
+    def on_road(self, road):
+        self.fleet.on_road[self.car_id] = -1 if road is None else road.road_id
+
+    @property
+    def on_lane(self):
+        """lane object"""
+        road = self.on_road
+        return None if road is None else road.lanes[self.fleet.on_lane[self.car_id]]
 
-        self.car_id = str(car_id)
-        self.start_cross_id = str(start_cross_id)
-        self.end_cross_id = str(end_cross_id)
-        self.highest_speed = int(highest_speed)
-        self.planned_departure_time = int(planned_departure_time)
+    @on_lane.setter
+    def on_lane(self, lane):
+        self.fleet.on_lane[self.car_id] = -1 if lane is None else lane.lane_id
 
-        self.state = None
-        self.current_speed = self.highest_speed
+    @property
+    def pass_intention(self):
+        return PASS_WAYS[self.fleet.pass_intention[self.car_id]]
 
-        self.ideal_time = None
-        self.ideal_arrival_time = None
-        self.ideal_path = None
+    @pass_intention.setter
+    def pass_intention(self, pass_way):
+        self.fleet.pass_intention[self.car_id] = PASS_WAY2CODE[pass_way]
 
-        self.departure_time = None  # departure time
-        self.passed_roads = []
-        self.passed_crosses = []
-        
-        self.on_road = None  # road id
-        self.on_lane = None  # lane id
-        self.on_position = None  # road position on lane
+    @property
+    def road_to_turn(self):
+        """road object"""
+        road_id = self.fleet.road_to_turn[self.car_id]
+        return None if road_id == -1 else self.fleet.roads[road_id]
 
-        self.pass_intention = None
-        self.road_to_turn = None
+    @road_to_turn.setter
+    def road_to_turn(self, road):
+        self.fleet.road_to_turn[self.car_id] = -1 if road is None else road.road_id
 
     def __str__(self):
-        return self.car_id
+        return str(self.car_id)
 
     def __repr__(self):
-        return self.car_id
\ No newline at end of file
+        return str(self.car_id)
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from utc.indexer import Indexer
+from utc.util import read_table
+
+# 编译格式的版本, 数组的含义或布局变化时加一, 旧的缓存随之失效
+COMPILED_VERSION = 3
+
+# 路口内的转向, 即下一条道路在路口 (顺时针排列的四条道路) 中相对当前道路的偏移, 0 表示不可通行
+NO_TURN = 0
+TURN_LEFT = 1
+GO_STRAIGHT = 2
+TURN_RIGHT = 3
+
+ARRAYS = (
+    # 官方 id, 升序, 下标即内部编号
+    'car_ids', 'road_ids', 'cross_ids',
+    # 车辆, 按内部编号; car_order 为车辆在文件中的顺序 (内部编号), Fleet 与答案都按此顺序排列
+    'car_from', 'car_to', 'car_speed', 'car_plan_time', 'car_order',
+    # 有向道路, 编号同 utc.road.Road: 道路 i 从 from 到 to 的方向为 2*i, 反方向为 2*i+1
+    'road_exists', 'road_length', 'road_speed', 'road_num_lanes', 'road_from', 'road_to',
+    # 路口四个方向上的 (无向) 道路, 驶入/驶出路口的有向道路, 以及有向道路在起点/终点路口中的方向
+    'cross_roads', 'cross_in_roads', 'cross_out_roads', 'road_start_slot', 'road_end_slot',
+    # 转向表: cross_turns[c, i, j] 为在路口 c 从方向 i 驶入, 从方向 j 驶出的转向
+    'cross_turns',
+    # 路网的 CSR 邻接表: 路口 c 驶出的有向道路为 adj_roads[adj_indptr[c]:adj_indptr[c+1]], 按道路编号升序,
+    # adj_crosses 为对应道路的终点路口
+    'adj_indptr', 'adj_roads', 'adj_crosses',
+)
+
+
+def map_digest(car_path, road_path, cross_path):
+    """三个地图文件内容 (及编译格式版本) 的摘要, 作为编译结果的文件名, 文件一变摘要即变"""
+    digest = hashlib.sha1(str(COMPILED_VERSION).encode())
+    for path in (car_path, road_path, cross_path):
+        with open(path, 'rb') as fin:
+            digest.update(hashlib.sha1(fin.read()).digest())
+    return digest.hexdigest()
+
+
+def compile_tables(cars_table, roads_table, crosses_table):
+    """由 utc.util.read_table 读出的三张表计算 ARRAYS 中的全部数组, 全部以数组运算完成"""
+    arrays = {}
+    car_indexer = Indexer.from_array(cars_table[:, 0])
+    road_indexer = Indexer.from_array(roads_table[:, 0])
+    cross_indexer = Indexer.from_array(crosses_table[:, 0])
+    arrays['car_ids'] = car_indexer.sorted_ids
+    arrays['road_ids'] = road_indexer.sorted_ids
+    arrays['cross_ids'] = cross_indexer.sorted_ids
+
+    num_cars = len(car_indexer)
+    car_ids = car_indexer.index_array(cars_table[:, 0])
+    for name, column, fill in (('car_from', 1, -1), ('car_to', 2, -1), ('car_speed', 3, 0), ('car_plan_time', 4, 0)):
+        arrays[name] = np.full(num_cars, fill, dtype=np.int32)
+    arrays['car_from'][car_ids] = cross_indexer.index_array(cars_table[:, 1])
+    arrays['car_to'][car_ids] = cross_indexer.index_array(cars_table[:, 2])
+    arrays['car_speed'][car_ids] = cars_table[:, 3]
+    arrays['car_plan_time'][car_ids] = cars_table[:, 4]
+    arrays['car_order'] = car_ids.astype(np.int32)
+
+    num_roads = 2 * len(road_indexer)
+    road_exists = np.zeros(num_roads, dtype=bool)
+    road_length = np.zeros(num_roads, dtype=np.int32)
+    road_speed = np.zeros(num_roads, dtype=np.int32)
+    road_num_lanes = np.zeros(num_roads, dtype=np.int32)
+    road_from = np.full(num_roads, -1, dtype=np.int32)
+    road_to = np.full(num_roads, -1, dtype=np.int32)
+    road_ids = road_indexer.index_array(roads_table[:, 0])
+    start_cross_ids = cross_indexer.index_array(roads_table[:, 4])
+    end_cross_ids = cross_indexer.index_array(roads_table[:, 5])
+    duplex = roads_table[:, 6] == 1
+    for rids, rows, s, e in ((2*road_ids, slice(None), start_cross_ids, end_cross_ids),
+                             (2*road_ids[duplex]+1, duplex, end_cross_ids[duplex], start_cross_ids[duplex])):
+        road_exists[rids] = True
+        road_length[rids] = roads_table[rows, 1]
+        road_speed[rids] = roads_table[rows, 2]
+        road_num_lanes[rids] = roads_table[rows, 3]
+        road_from[rids] = s
+        road_to[rids] = e
+    arrays.update(road_exists=road_exists, road_length=road_length, road_speed=road_speed,
+                  road_num_lanes=road_num_lanes, road_from=road_from, road_to=road_to)
+
+    num_crosses = len(cross_indexer)
+    cross_roads = np.full((num_crosses, 4), -1, dtype=np.int32)
+    cross_in_roads = np.full((num_crosses, 4), -1, dtype=np.int32)
+    cross_out_roads = np.full((num_crosses, 4), -1, dtype=np.int32)
+    road_start_slot = np.full(num_roads, -1, dtype=np.int8)
+    road_end_slot = np.full(num_roads, -1, dtype=np.int8)
+    cross_ids = cross_indexer.index_array(crosses_table[:, 0])
+    for slot in range(4):
+        has_road = crosses_table[:, 1+slot] != -1
+        road_ids = road_indexer.index_array(crosses_table[has_road, 1+slot])
+        slot_cross_ids = cross_ids[has_road]
+        cross_roads[slot_cross_ids, slot] = road_ids
+        for rids in (2*road_ids, 2*road_ids+1):
+            incoming = road_exists[rids] & (road_to[rids] == slot_cross_ids)
+            cross_in_roads[slot_cross_ids[incoming], slot] = rids[incoming]
+            road_end_slot[rids[incoming]] = slot
+            outgoing = road_exists[rids] & (road_from[rids] == slot_cross_ids)
+            cross_out_roads[slot_cross_ids[outgoing], slot] = rids[outgoing]
+            road_start_slot[rids[outgoing]] = slot
+    arrays.update(cross_roads=cross_roads, cross_in_roads=cross_in_roads, cross_out_roads=cross_out_roads,
+                  road_start_slot=road_start_slot, road_end_slot=road_end_slot)
+
+    # 只有驶入与驶出方向都有道路时才能转向; 同一方向驶入再驶出即掉头, 不允许
+    offsets = (np.arange(4)[None, :] - np.arange(4)[:, None]) % 4
+    arrays['cross_turns'] = np.where(
+        (cross_in_roads[:, :, None] != -1) & (cross_out_roads[:, None, :] != -1) & (offsets != 0),
+        offsets, NO_TURN).astype(np.int8)
+
+    directed_roads = np.flatnonzero(road_exists)
+    adj_roads = directed_roads[np.argsort(road_from[directed_roads], kind='stable')].astype(np.int32)
+    arrays['adj_indptr'] = np.concatenate(
+        ([0], np.cumsum(np.bincount(road_from[adj_roads], minlength=num_crosses)))).astype(np.int32)
+    arrays['adj_roads'] = adj_roads
+    arrays['adj_crosses'] = road_to[adj_roads]
+    return arrays
+
+
+class CompiledMap(object):
+    """编译后的地图, 各数组见 ARRAYS. 从缓存加载时数组以只读方式内存映射, 多个进程共享同一份页缓存."""
+
+    def __init__(self, arrays):
+        super(CompiledMap, self).__init__()
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.car_indexer = Indexer.from_array(self.car_ids)
+        self.road_indexer = Indexer.from_array(self.road_ids)
+        self.cross_indexer = Indexer.from_array(self.cross_ids)
+
+    @classmethod
+    def from_files(cls, car_path, road_path, cross_path):
+        """不经缓存, 直接解析并编译"""
+        return cls(compile_tables(read_table(car_path), read_table(road_path), read_table(cross_path)))
+
+    def save(self, path):
+        """每个数组存为 path 目录下的一个 .npy 文件. 先写临时目录再改名, 中途退出也不会留下残缺的缓存"""
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:  # 其他进程已经写好了同一份缓存
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        return cls({name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ARRAYS})
+
+
+def load_compiled_map(car_path, road_path, cross_path, cache_dir=None):
+    """cache_dir 下有这三个文件的编译结果时直接内存映射, 没有则编译并写入缓存. cache_dir 为 None 时不用缓存"""
+    if cache_dir is None:
+        return CompiledMap.from_files(car_path, road_path, cross_path)
+    path = os.path.join(cache_dir, map_digest(car_path, road_path, cross_path))
+    if not os.path.isdir(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        CompiledMap.from_files(car_path, road_path, cross_path).save(path)
+    return CompiledMap.load(path)
@@ -1,52 +1,42 @@
 from collections import OrderedDict
 
+from utc.compiled import NO_TURN, TURN_LEFT, GO_STRAIGHT, TURN_RIGHT
+
+# 转向表中的转向 -> 车辆的过路口意图 (见 utc.car.PASS_WAYS)
+TURN2PASS_WAY = {NO_TURN: None, TURN_LEFT: 'turn_left', GO_STRAIGHT: 'go_straight', TURN_RIGHT: 'turn_right'}
+
+
 class Cross(object):
-    def __init__(self, cross_id, connected_roads):
+    def __init__(self, cross_id, connected_roads, in_roads, turns, adj_roads, adj_crosses):
+        """路口的各张表都由 utc.compiled 编译好, 这里只保存 (内存映射的) 数组视图, 不再重建:
+            * connected_roads: 顺时针四个方向上的 (无向) 道路
+            * in_roads: 四个方向上驶入路口的有向道路
+            * turns: turns[i, j] 为从方向 i 驶入, 从方向 j 驶出的转向
+            * adj_roads, adj_crosses: 驶出路口的有向道路及其终点路口, 即 CSR 邻接表的一行
+        """
         assert len(connected_roads) == 4
-        self.cross_id = str(cross_id)
+        # 路口与道路均使用内部编号 (见 utc.indexer), -1 表示无路可走
+        self.cross_id = int(cross_id)
 
         self.connected_roads = connected_roads
-        self.generate_road_pair_and_pass_way_mapping(connected_roads)
-        
-    def generate_road_pair_and_pass_way_mapping(self, roads):
-        pass_way2road_pair = {'turn_left': [], 'go_straight': [], 'turn_right': []}
-        road_pair2pass_way = {}
-        for i in range(len(roads)):
-            if roads[i] == '-1':
-                continue
-            if roads[(i+1)%4] != '-1':
-                pass_way2road_pair['turn_left'].append((roads[i], roads[(i+1)%4]))
-                road_pair2pass_way[(roads[i], roads[(i+1)%4])] = 'turn_left'
-            if roads[(i+2)%4] != '-1':
-                pass_way2road_pair['go_straight'].append((roads[i], roads[(i+2)%4]))
-                road_pair2pass_way[(roads[i], roads[(i+2)%4])] = 'go_straight'
-            if roads[(i+3)%4] != '-1':
-                pass_way2road_pair['turn_right'].append((roads[i], roads[(i+3)%4]))
-                road_pair2pass_way[(roads[i], roads[(i+3)%4])] = 'turn_right'
-        self.pass_way2road_pair = pass_way2road_pair
-        self.road_pair2pass_way = road_pair2pass_way
+        self.in_roads = in_roads
+        self.turns = turns
+        self.adj_roads = adj_roads
+        self.adj_crosses = adj_crosses
+
+    def get_pass_way(self, road_in, road_out):
+        """从道路 road_in 驶入, 从 road_out 驶出的过路口意图, 不可通行 (如掉头) 时为 None"""
+        return TURN2PASS_WAY[self.turns[road_in.end_slot, road_out.start_slot]]
 
     def connect_with_roads(self, roads_dict):
         connected_roads = OrderedDict()
-        for road_id in sorted(self.connected_roads,  key=lambda t: int(t)):
-            if road_id == '-1':
-                if '-1' not in connected_roads:
-                    connected_roads['-1'] = None
+        for road_id, in_road_id in sorted(zip(self.connected_roads, self.in_roads.tolist())):
+            if in_road_id == -1:  # 没有道路, 或道路不驶入本路口
+                if -1 not in connected_roads:
+                    connected_roads[-1] = None
                 else:
-                    connected_roads['-2'] = None
+                    connected_roads[-2] = None
                 continue
-            for i in range(1, 3):
-                rid = road_id+'#{}'.format(i)
-                road = roads_dict.get(rid)
-                if not road:
-                    continue
-                if road.end_cross_id == self.cross_id:
-                    connected_roads[road_id] = roads_dict.get(rid)
-                    break
-            else:
-                if '-1' not in connected_roads:
-                    connected_roads['-1'] = None
-                else:
-                    connected_roads['-2'] = None
-                
+            connected_roads[road_id] = roads_dict[in_road_id]
+
         self.connected_roads = connected_roads
@@ -0,0 +1,129 @@
+import numpy as np
+
+from utc.car import Car
+
+ROUTE_CAPACITY = 8  # 每辆车初始预留的路线长度
+
+# 调度过程中会变化的数组, 快照只需保存这些; 目的地/最高车速/计划出发时间是不变的.
+# start_cross_id 随车辆行驶更新为车辆前方的路口
+MUTABLE_FIELDS = (
+    'start_cross_id', 'state', 'current_speed', 'ideal_time', 'ideal_arrival_time', 'departure_time',
+    'on_road', 'on_lane', 'on_position', 'pass_intention', 'road_to_turn',
+    'route_roads', 'route_crosses', 'route_offsets', 'route_lengths', 'route_capacities',
+)
+
+
+class Fleet(object):
+    """全部车辆状态的列式存储 (struct of arrays).
+
+    每个属性是一个以 car_id 为下标的 NumPy 数组, 车辆本身只是 utc.car.Car 视图;
+    车辆经过的道路与路口保存在扁平的 int32 缓冲区中, 每辆车占用其中的一段,
+    由 route_offsets/route_lengths/route_capacities 记录, 段满时整体搬到缓冲区末尾并扩容一倍.
+    car_id 是 utc.indexer 分配的内部编号, 因此恰好是 0..N-1.
+    """
+
+    def __init__(self, num_cars):
+        super(Fleet, self).__init__()
+        self.num_cars = num_cars
+        self.cars = []  # 按添加顺序排列的车辆视图
+        self.roads = {}  # road_id -> Road, 由调度器绑定, 用于把编号还原成道路对象
+        self.state_listener = None  # 车辆状态变更时的回调, 由调度器挂载
+
+        self.start_cross_id = np.full(num_cars, -1, dtype=np.int32)
+        self.end_cross_id = np.full(num_cars, -1, dtype=np.int32)
+        self.highest_speed = np.zeros(num_cars, dtype=np.int32)
+        self.planned_departure_time = np.zeros(num_cars, dtype=np.int32)
+
+        self.state = np.zeros(num_cars, dtype=np.int8)  # 0 表示尚未上路
+        self.current_speed = np.zeros(num_cars, dtype=np.int32)
+
+        self.ideal_time = np.full(num_cars, -1, dtype=np.float64)
+        self.ideal_arrival_time = np.full(num_cars, -1, dtype=np.float64)
+        self.ideal_paths = [None] * num_cars
+
+        self.departure_time = np.full(num_cars, -1, dtype=np.int32)
+        self.on_road = np.full(num_cars, -1, dtype=np.int32)
+        self.on_lane = np.full(num_cars, -1, dtype=np.int32)
+        self.on_position = np.full(num_cars, -1, dtype=np.int32)
+
+        self.pass_intention = np.zeros(num_cars, dtype=np.int8)
+        self.road_to_turn = np.full(num_cars, -1, dtype=np.int32)
+
+        self.route_roads = np.empty(num_cars * ROUTE_CAPACITY, dtype=np.int32)
+        self.route_crosses = np.empty(num_cars * ROUTE_CAPACITY, dtype=np.int32)
+        self.route_offsets = np.arange(num_cars, dtype=np.int64) * ROUTE_CAPACITY
+        self.route_lengths = np.zeros(num_cars, dtype=np.int32)
+        self.route_capacities = np.full(num_cars, ROUTE_CAPACITY, dtype=np.int32)
+        self.route_end = num_cars * ROUTE_CAPACITY  # 缓冲区中第一个未分配的位置
+
+    def add_cars(self, car_ids, start_cross_ids, end_cross_ids,
+                 highest_speeds, planned_departure_times):
+        """批量添加车辆, 参数都是数组, 车辆按数组的顺序添加"""
+        self.start_cross_id[car_ids] = start_cross_ids
+        self.end_cross_id[car_ids] = end_cross_ids
+        self.highest_speed[car_ids] = highest_speeds
+        self.current_speed[car_ids] = highest_speeds
+        self.planned_departure_time[car_ids] = planned_departure_times
+
+        cars = [Car(self, car_id) for car_id in np.asarray(car_ids).tolist()]
+        self.cars.extend(cars)
+        return cars
+
+    def bind_roads(self, roads):
+        self.roads = roads
+
+    def append_route(self, car_id, road_id, cross_id):
+        """车辆驶入一条道路, 记录道路与驶入时经过的路口"""
+        length = self.route_lengths[car_id]
+        if length == self.route_capacities[car_id]:
+            self._grow_route(car_id)
+        offset = self.route_offsets[car_id] + length
+        self.route_roads[offset] = road_id
+        self.route_crosses[offset] = cross_id
+        self.route_lengths[car_id] = length + 1
+
+    def _grow_route(self, car_id):
+        offset = self.route_offsets[car_id]
+        length = self.route_lengths[car_id]
+        capacity = 2 * self.route_capacities[car_id]
+
+        if self.route_end + capacity > len(self.route_roads):
+            size = max(2 * len(self.route_roads), self.route_end + capacity)
+            self.route_roads = np.resize(self.route_roads, size)
+            self.route_crosses = np.resize(self.route_crosses, size)
+
+        self.route_roads[self.route_end:self.route_end+length] = self.route_roads[offset:offset+length]
+        self.route_crosses[self.route_end:self.route_end+length] = self.route_crosses[offset:offset+length]
+        self.route_offsets[car_id] = self.route_end
+        self.route_capacities[car_id] = capacity
+        self.route_end += capacity
+
+    def get_route(self, car_id):
+        """返回车辆经过的道路与路口, 是缓冲区的视图, 缓冲区扩容后失效, 不要长期持有"""
+        offset = self.route_offsets[car_id]
+        length = self.route_lengths[car_id]
+        return self.route_roads[offset:offset+length], self.route_crosses[offset:offset+length]
+
+    def snapshot(self):
+        """保存全部可变状态, 只是若干次数组拷贝"""
+        state = {name: getattr(self, name).copy() for name in MUTABLE_FIELDS}
+        state['ideal_paths'] = list(self.ideal_paths)  # 路线只会被整体替换, 浅拷贝即可
+        state['route_end'] = self.route_end
+        return state
+
+    def restore(self, state):
+        """恢复到 snapshot 时的状态, 不触发 state_listener. 快照可以多次恢复"""
+        for name in MUTABLE_FIELDS:
+            array = getattr(self, name)
+            if array.shape == state[name].shape:
+                np.copyto(array, state[name])
+            else:  # 路线缓冲区在快照之后扩容过
+                setattr(self, name, state[name].copy())
+        self.ideal_paths[:] = state['ideal_paths']
+        self.route_end = state['route_end']
+
+    def __len__(self):
+        return len(self.cars)
+
+    def __iter__(self):
+        return iter(self.cars)
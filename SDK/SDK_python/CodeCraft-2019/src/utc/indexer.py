@@ -0,0 +1,54 @@
+import numpy as np
+
+from utc.util import read_file_and_yield_info
+
+
+class Indexer(object):
+    """官方 id (字符串) 与内部编号 (0..N-1 的连续整数) 之间的双向映射.
+
+    按官方 id 的数值升序编号, 因此按内部编号排序与按官方 id 排序的结果一致,
+    调度器内部只使用整数编号, 只在写答案时才转换回官方 id.
+    """
+
+    def __init__(self, external_ids, sorted_ids=None):
+        super(Indexer, self).__init__()
+        if sorted_ids is None:
+            self.index2id = sorted(set(external_ids), key=lambda i: int(i))
+        else:
+            self.index2id = list(external_ids)  # 已按数值升序去重
+        self.id2index = {external_id: index for index, external_id in enumerate(self.index2id)}
+        self.sorted_ids = sorted_ids  # 整数形式的官方 id, 供 index_array 二分查找, 用到时才生成
+
+    @classmethod
+    def from_file(cls, fname):
+        """以文件中每一行的第一列作为官方 id"""
+        return cls([info[0] for info in read_file_and_yield_info(fname)])
+
+    @classmethod
+    def from_array(cls, external_ids):
+        """以整数数组 (如 utc.util.read_table 的一列) 作为官方 id"""
+        sorted_ids = np.unique(external_ids)
+        return cls([str(external_id) for external_id in sorted_ids.tolist()], sorted_ids=sorted_ids)
+
+    def index_array(self, external_ids):
+        """index 的批量版本, external_ids 为整数数组, 返回内部编号的数组"""
+        if self.sorted_ids is None:
+            self.sorted_ids = np.array([int(external_id) for external_id in self.index2id], dtype=np.int64)
+        external_ids = np.asarray(external_ids)
+        index = np.minimum(np.searchsorted(self.sorted_ids, external_ids), len(self.sorted_ids) - 1)
+        missing = self.sorted_ids[index] != external_ids
+        if missing.any():
+            raise KeyError(str(external_ids[missing][0]))
+        return index
+
+    def index(self, external_id):
+        return self.id2index[external_id]
+
+    def external_id(self, index):
+        return self.index2id[index]
+
+    def __len__(self):
+        return len(self.index2id)
+
+    def __contains__(self, external_id):
+        return external_id in self.id2index
@@ -0,0 +1,90 @@
+import numpy as np
+
+from utc.car import CAR_RUNNING, CAR_STOP, CAR_END
+
+
+def move_cars_on_the_same_way(car_ids, positions, speeds, highest_speeds, states,
+                              at_destination, lane_speeds):
+    """第一步调度 (只在本车道上行驶的车辆) 的批量版本, 与 Scheduler._schedule_cars_move_on_the_same_way 逐车的结果完全一致.
+
+    每一行是一条车道, 每一列是车道上从路口开始数的第 k 辆车, car_ids 为 -1 的位置是填充.
+    同一车道内的车辆有前后依赖, 因此按列推进; 不同车道之间互不影响, 每一列对所有车道同时计算.
+    规划路线与更新路权依赖路网, 不在这里处理, 只返回需要处理的车辆, 由调度器按原先的顺序补上.
+
+    返回 (新位置, 新车速, 新状态, 是否移动, 是否到达终点, 是否进入等待调度状态), 形状都与 car_ids 相同.
+    """
+    num_lanes, num_cols = car_ids.shape
+
+    new_positions = positions.copy()
+    new_speeds = speeds.copy()
+    new_states = states.copy()
+    moved = np.zeros(car_ids.shape, dtype=bool)
+    ended = np.zeros(car_ids.shape, dtype=bool)
+    waiting = np.zeros(car_ids.shape, dtype=bool)
+
+    # 当前车辆的前车, 即同一车道上一辆仍在车道上的车
+    prev_exists = np.zeros(num_lanes, dtype=bool)
+    prev_position = np.zeros(num_lanes, dtype=positions.dtype)
+    prev_speed = np.zeros(num_lanes, dtype=speeds.dtype)
+    prev_state = np.zeros(num_lanes, dtype=states.dtype)
+    prev_moved = np.zeros(num_lanes, dtype=bool)
+
+    for k in range(num_cols):
+        valid = car_ids[:, k] >= 0
+        pos = positions[:, k]
+        highest = highest_speeds[:, k]
+        state = states[:, k]
+
+        # 前车前进之后, 会更新后车的车速, 无论后车是否已完成调度
+        speed = np.where(prev_moved & valid, np.minimum(prev_speed, highest), speeds[:, k])
+
+        active = valid & (state != CAR_STOP) & (state != CAR_END)
+        no_prev = active & ~prev_exists
+        with_stopped_prev = active & prev_exists & (prev_state == CAR_STOP)
+        with_running_prev = active & prev_exists & (prev_state == CAR_RUNNING)
+        if (active & prev_exists & ~(with_stopped_prev | with_running_prev)).any():
+            raise RuntimeError('迷路了吧')
+
+        # 1. 无前车
+        before_cross = no_prev & (pos > speed)   # 1.1. 不足以穿过路口, 跟着路口走
+        reach_cross = no_prev & (pos == speed)   # 1.1. 恰好开到路口
+        through_cross = no_prev & (speed > pos)  # 1.2 经过路口的
+        arrive = through_cross & at_destination[:, k]
+        # 2. 前车已完成调度
+        distance = pos - prev_position
+        not_following = with_stopped_prev & (distance > speed)
+        following = with_stopped_prev & (distance == speed)
+
+        forward = np.zeros(num_lanes, dtype=positions.dtype)
+        forward = np.where(before_cross, speed, forward)
+        forward = np.where(reach_cross, pos, forward)
+        forward = np.where(not_following, speed, forward)
+        forward = np.where(following, speed - 1, forward)
+
+        speed = np.where(before_cross | reach_cross, np.minimum(lane_speeds, highest), speed)
+        speed = np.where(following, np.minimum(prev_speed, highest), speed)
+
+        state = np.where(no_prev | with_stopped_prev, CAR_STOP, state)
+        state = np.where(arrive, CAR_END, state)
+        to_wait = (through_cross & ~arrive) | with_running_prev
+        state = np.where(to_wait, CAR_RUNNING, state)
+
+        moved_k = before_cross | reach_cross | not_following | following
+        pos = pos - forward
+
+        new_positions[:, k] = pos
+        new_speeds[:, k] = speed
+        new_states[:, k] = state
+        moved[:, k] = moved_k
+        ended[:, k] = arrive
+        waiting[:, k] = to_wait
+
+        # 到达终点的车离开车道, 后车没有前车
+        stays = valid & ~arrive
+        prev_exists = np.where(valid, stays, prev_exists)
+        prev_position = np.where(stays, pos, prev_position)
+        prev_speed = np.where(stays, speed, prev_speed)
+        prev_state = np.where(stays, state, prev_state)
+        prev_moved = moved_k
+
+    return new_positions, new_speeds, new_states, moved, ended, waiting
@@ -0,0 +1,63 @@
+import numpy as np
+
+from utc.compiled import load_compiled_map
+from utc.cross import Cross
+from utc.fleet import Fleet
+from utc.road import Road
+
+
+def write_answer(answer_path, cars, car_indexer, road_indexer):
+    """内部编号只在这里转换回官方 id"""
+    with open(answer_path, 'w') as fout:
+        for car in cars:
+            answer = [car_indexer.external_id(car.car_id)] + [str(car.departure_time)] + \
+                     [road_indexer.external_id(road_id // 2) for road_id in car.passed_roads]
+            answer = '(' + ', '.join(answer) + ')\n'
+            fout.write(answer)
+
+
+def build_cars(compiled_map):
+    """由编译好的地图 (utc.compiled.CompiledMap) 批量构造 Fleet, 车辆按文件中的顺序添加, 答案也按此顺序写出"""
+    car_ids = compiled_map.car_order
+    cars = Fleet(len(compiled_map.car_ids))
+    cars.add_cars(car_ids=car_ids,
+                  start_cross_ids=compiled_map.car_from[car_ids], end_cross_ids=compiled_map.car_to[car_ids],
+                  highest_speeds=compiled_map.car_speed[car_ids],
+                  planned_departure_times=compiled_map.car_plan_time[car_ids])
+    return cars
+
+def build_crosses(compiled_map):
+    """由编译好的地图构造路口, 按内部编号排列, 没有道路的方向为 -1. 转向表与邻接表都是编译结果的视图"""
+    indptr = compiled_map.adj_indptr.tolist()
+    return [
+        Cross(cross_id=cross_id, connected_roads=connected_roads,
+              in_roads=compiled_map.cross_in_roads[cross_id], turns=compiled_map.cross_turns[cross_id],
+              adj_roads=compiled_map.adj_roads[indptr[cross_id]:indptr[cross_id+1]],
+              adj_crosses=compiled_map.adj_crosses[indptr[cross_id]:indptr[cross_id+1]])
+        for cross_id, connected_roads in enumerate(compiled_map.cross_roads.tolist())
+    ]
+
+def build_roads(compiled_map):
+    """由编译好的地图构造有向道路: 双向道路拆成两条, 编号分别为 2*i 与 2*i+1, i 为道路的内部编号"""
+    road_ids = np.flatnonzero(compiled_map.road_exists)
+    return [
+        Road(road_id=road_id, length=length, highest_speed=speed, num_lane=num_lane,
+             start_cross_id=s, end_cross_id=e, start_slot=start_slot, end_slot=end_slot)
+        for road_id, length, speed, num_lane, s, e, start_slot, end_slot in zip(
+            road_ids.tolist(), compiled_map.road_length[road_ids].tolist(),
+            compiled_map.road_speed[road_ids].tolist(), compiled_map.road_num_lanes[road_ids].tolist(),
+            compiled_map.road_from[road_ids].tolist(), compiled_map.road_to[road_ids].tolist(),
+            compiled_map.road_start_slot[road_ids].tolist(), compiled_map.road_end_slot[road_ids].tolist())
+    ]
+
+
+def load_map(car_path, road_path, cross_path, cache_dir=None):
+    """读入三个地图文件并批量构造, 返回 (cars, crosses, roads, car_indexer, road_indexer).
+
+    指定 cache_dir 时地图只编译一次, 之后直接内存映射编译结果, 见 utc.compiled.
+    """
+    compiled_map = load_compiled_map(car_path, road_path, cross_path, cache_dir)
+    cars = build_cars(compiled_map)
+    crosses = build_crosses(compiled_map)
+    roads = build_roads(compiled_map)
+    return cars, crosses, roads, compiled_map.car_indexer, compiled_map.road_indexer
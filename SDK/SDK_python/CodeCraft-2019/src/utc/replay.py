@@ -0,0 +1,420 @@
+import argparse
+import heapq
+import multiprocessing
+import os
+from collections import deque
+
+import numpy as np
+
+from utc.compiled import TURN_LEFT, GO_STRAIGHT, TURN_RIGHT, load_compiled_map
+from utc.util import read_file_and_yield_info
+
+class ReplayMap(object):
+    """官方地图的紧凑表示, 构造后只读, 可被多次回放共享.
+
+    路口/道路/车辆都使用 utc.indexer 的内部编号, 有向道路的编号与 utc.road.Road 一致:
+    道路 i 从 from 到 to 的方向为 2*i, 反方向为 2*i+1, 单向道路的 2*i+1 不存在 (road_exists 为 False).
+    各数组直接取自 utc.compiled.CompiledMap.
+    """
+
+    def __init__(self, compiled_map):
+        super(ReplayMap, self).__init__()
+        self.car_indexer = compiled_map.car_indexer
+        self.road_indexer = compiled_map.road_indexer
+        self.cross_indexer = compiled_map.cross_indexer
+        for name in ('car_from', 'car_to', 'car_speed', 'car_plan_time',
+                     'road_exists', 'road_length', 'road_speed', 'road_num_lanes', 'road_from', 'road_to',
+                     'cross_in_roads', 'cross_out_roads', 'road_start_slot', 'road_end_slot'):
+            setattr(self, name, getattr(compiled_map, name))
+
+    @classmethod
+    def from_files(cls, car_path, road_path, cross_path, cache_dir=None):
+        return cls(load_compiled_map(car_path, road_path, cross_path, cache_dir))
+
+    def read_answer(self, answer_path):
+        """读取 write_answer 格式的答案, 返回 (出发时间, 有向道路编号的路线).
+
+        答案不合法 (格式错误, 未知的 id, 缺车, 早于计划时间出发, 路线断开/掉头/不通向终点) 时抛出 RuntimeError.
+        """
+        num_cars = len(self.car_indexer)
+        start_times = np.full(num_cars, -1, dtype=np.int32)
+        routes = [None] * num_cars
+        for answer in read_file_and_yield_info(answer_path):
+            try:
+                car_id = self.car_indexer.index(answer[0])
+                start_time = int(answer[1])
+                road_ids = [self.road_indexer.index(r) for r in answer[2:]]
+            except KeyError as e:
+                raise RuntimeError('答案中有未知的 id {}: ({})'.format(e, ', '.join(answer)))
+            except (IndexError, ValueError):
+                raise RuntimeError('答案的格式错误: ({})'.format(', '.join(answer)))
+            start_times[car_id] = start_time
+            routes[car_id] = self._to_directed_route(car_id, road_ids)
+
+        missing = [self.car_indexer.external_id(car_id) for car_id in range(num_cars) if routes[car_id] is None]
+        if missing:
+            raise RuntimeError('答案中缺少{}辆车, 例如{}'.format(len(missing), missing[0]))
+        early = np.flatnonzero(start_times < self.car_plan_time)
+        if len(early):
+            raise RuntimeError('车辆{}早于计划时间出发'.format(self.car_indexer.external_id(early[0])))
+        return start_times, routes
+
+    def _to_directed_route(self, car_id, road_ids):
+        cross_id = self.car_from[car_id]
+        route = []
+        for road_id in road_ids:
+            for rid in (2*road_id, 2*road_id+1):
+                if self.road_exists[rid] and self.road_from[rid] == cross_id:
+                    break
+            else:
+                raise RuntimeError('车辆{}的路线在路口{}处断开'.format(
+                    self.car_indexer.external_id(car_id), self.cross_indexer.external_id(cross_id)))
+            if route and route[-1] // 2 == road_id:
+                raise RuntimeError('车辆{}的路线掉头'.format(self.car_indexer.external_id(car_id)))
+            route.append(rid)
+            cross_id = self.road_to[rid]
+        if not route or cross_id != self.car_to[car_id]:
+            raise RuntimeError('车辆{}的路线没有到达终点'.format(self.car_indexer.external_id(car_id)))
+        return route
+
+
+class ReplayResult(object):
+    def __init__(self, schedule_time, total_time, num_arrived, deadlock):
+        super(ReplayResult, self).__init__()
+        self.schedule_time = schedule_time  # 系统调度时间, 即最后一辆车到达的时间片
+        self.total_time = total_time        # 所有车辆的总调度时间, 到达时间减计划出发时间之和
+        self.num_arrived = num_arrived
+        self.deadlock = deadlock
+
+    def __repr__(self):
+        return 'ReplayResult(schedule_time={}, total_time={}, num_arrived={}, deadlock={})'.format(
+            self.schedule_time, self.total_time, self.num_arrived, self.deadlock)
+
+
+class Replay(object):
+    """按官方调度规则回放固定的出发时间与路线, 与 utc.scheduler.Scheduler 无关.
+
+    每个时间片:
+        1. 所有道路上的车辆在本车道内行驶, 能走完的标记为终止, 要过路口或被等待车辆挡住的标记为等待;
+        2. 按路口 id 升序, 路口内按道路 id 升序, 反复调度每条道路优先级最高的等待车辆过路口,
+           直行优先, 左转让直行, 右转让直行与左转, 到达终点视为直行; 一整轮没有进展即为死锁;
+        3. 已到出发时间的车辆按车辆 id 升序上路, 道路已满的推迟到下一个时间片.
+    车道是从路口向后排列的车辆队列, 车辆状态是以 car_id 为下标的 list,
+    车辆在本时间片已完成调度记为 done[car] == 当前时间片, 因此不必每个时间片重置.
+    """
+
+    def __init__(self, replay_map, start_times, routes):
+        super(Replay, self).__init__()
+        self.map = replay_map
+        self.start_times = start_times
+        self.routes = routes
+
+        # 热循环中逐个访问元素, list 比 NumPy 数组快得多
+        self.length = replay_map.road_length.tolist()
+        self.road_speed = replay_map.road_speed.tolist()
+        self.road_end_slot = replay_map.road_end_slot.tolist()
+        self.road_start_slot = replay_map.road_start_slot.tolist()
+        self.cross_in_roads = replay_map.cross_in_roads.tolist()
+        self.car_speed = replay_map.car_speed.tolist()
+        # 路口内按道路 id 升序调度, 有向道路编号的顺序与道路 id 一致
+        self.cross_schedule_roads = [sorted(r for r in roads if r >= 0) for roads in self.cross_in_roads]
+
+        num_cars = len(routes)
+        self.lanes = [
+            [deque() for _ in range(num_lanes)] if exists else []
+            for exists, num_lanes in zip(replay_map.road_exists.tolist(), replay_map.road_num_lanes.tolist())
+        ]
+        self.position = [0] * num_cars
+        self.lane = [-1] * num_cars
+        self.hop = [-1] * num_cars  # 当前道路在路线中的下标
+        self.done = [-1] * num_cars
+        self.arrival_time = [-1] * num_cars
+
+        self.current_time = 0
+        self.num_on_road = 0
+        self.num_waiting = 0
+        self.num_arrived = 0
+        self.departure_queue = [(int(start_times[car]), car) for car in range(num_cars)]
+        heapq.heapify(self.departure_queue)
+        self.garage = []  # 已到出发时间但还没能上路的车辆 id 堆
+
+    def run(self, max_time=None):
+        num_cars = len(self.routes)
+        deadlock = False
+        while self.num_arrived < num_cars:
+            if self.num_on_road == 0 and not self.garage:
+                # 路网空闲, 直接跳到下一个出发时间
+                self.current_time = max(self.current_time + 1, self.departure_queue[0][0])
+            else:
+                self.current_time += 1
+            if max_time is not None and self.current_time > max_time:
+                break
+
+            self._drive_all_roads()
+            if not self._schedule_crosses():
+                deadlock = True
+                break
+            self._start_off_cars()
+
+        plan_time = self.map.car_plan_time
+        arrived = [car for car in range(num_cars) if self.arrival_time[car] >= 0]
+        total_time = sum(self.arrival_time[car] - int(plan_time[car]) for car in arrived)
+        schedule_time = self.current_time if deadlock else max([self.arrival_time[car] for car in arrived] or [0])
+        return ReplayResult(schedule_time, total_time, self.num_arrived, deadlock)
+
+    def _drive_all_roads(self):
+        self.num_waiting = self.num_on_road
+        for road_id, lanes in enumerate(self.lanes):
+            for lane in lanes:
+                if lane:
+                    self._drive_lane(road_id, lane)
+
+    def _drive_lane(self, road_id, lane):
+        """车道内从前往后调度尚未完成调度的车辆, 不过路口"""
+        t = self.current_time
+        position = self.position
+        done = self.done
+        car_speed = self.car_speed
+        length = self.length[road_id]
+        road_speed = self.road_speed[road_id]
+
+        prev_position = None
+        prev_done = True
+        for car in lane:
+            if done[car] != t:
+                p = position[car] + min(car_speed[car], road_speed)
+                if prev_position is None:
+                    if p <= length:
+                        position[car] = p
+                        done[car] = t
+                        self.num_waiting -= 1
+                elif p < prev_position:
+                    position[car] = p
+                    done[car] = t
+                    self.num_waiting -= 1
+                elif prev_done:
+                    position[car] = prev_position - 1
+                    done[car] = t
+                    self.num_waiting -= 1
+            prev_position = position[car]
+            prev_done = done[car] == t
+
+    def _first_waiting_car(self, road_id):
+        """道路上优先级最高的等待车辆 (离路口最近, 其次车道编号最小), 没有则返回 -1"""
+        t = self.current_time
+        best_car = -1
+        best_position = -1
+        for lane in self.lanes[road_id]:
+            if lane:
+                car = lane[0]
+                if self.done[car] != t and self.position[car] > best_position:
+                    best_car = car
+                    best_position = self.position[car]
+        return best_car
+
+    def _turn(self, car, road_id):
+        route = self.routes[car]
+        if self.hop[car] + 1 == len(route):
+            return GO_STRAIGHT  # 到达终点视为直行
+        return (self.road_start_slot[route[self.hop[car]+1]] - self.road_end_slot[road_id]) % 4
+
+    def _has_conflict(self, cross_id, road_id, turn):
+        if turn == GO_STRAIGHT:
+            return False
+        in_roads = self.cross_in_roads[cross_id]
+        slot = self.road_end_slot[road_id]
+        if turn == TURN_LEFT:
+            conflicts = ((in_roads[(slot+3) % 4], GO_STRAIGHT),)
+        else:
+            conflicts = ((in_roads[(slot+1) % 4], GO_STRAIGHT), (in_roads[(slot+2) % 4], TURN_LEFT))
+        for other_road_id, other_turn in conflicts:
+            if other_road_id < 0:
+                continue
+            other_car = self._first_waiting_car(other_road_id)
+            if other_car >= 0 and self._turn(other_car, other_road_id) == other_turn:
+                return True
+        return False
+
+    def _schedule_crosses(self):
+        """按路口 id 升序反复调度, 直到没有等待车辆. 发生死锁时返回 False"""
+        while self.num_waiting > 0:
+            num_waiting = self.num_waiting
+            for cross_id, road_ids in enumerate(self.cross_schedule_roads):
+                for road_id in road_ids:
+                    while True:
+                        car = self._first_waiting_car(road_id)
+                        if car < 0 or self._has_conflict(cross_id, road_id, self._turn(car, road_id)):
+                            break
+                        lane = self.lanes[road_id][self.lane[car]]
+                        if not self._pass_cross(car, road_id, lane):
+                            break
+                        self._drive_lane(road_id, lane)
+            if self.num_waiting == num_waiting:
+                return False
+        return True
+
+    def _pass_cross(self, car, road_id, lane):
+        """车辆过路口, 被下一条道路上的等待车辆挡住时返回 False"""
+        t = self.current_time
+        route = self.routes[car]
+        hop = self.hop[car]
+        if hop + 1 == len(route):
+            lane.popleft()
+            self.done[car] = t
+            self.arrival_time[car] = t
+            self.num_waiting -= 1
+            self.num_on_road -= 1
+            self.num_arrived += 1
+            return True
+
+        next_road_id = route[hop+1]
+        distance = self.length[road_id] - self.position[car]
+        next_distance = min(self.car_speed[car], self.road_speed[next_road_id]) - distance
+        next_distance = min(next_distance, self.length[next_road_id])
+        if next_distance > 0:
+            for k, next_lane in enumerate(self.lanes[next_road_id]):
+                if next_lane:
+                    tail = next_lane[-1]
+                    tail_position = self.position[tail]
+                    if tail_position <= next_distance:
+                        if self.done[tail] != t:
+                            return False
+                        if tail_position == 1:
+                            continue  # 车道已满, 看下一条车道
+                        next_distance = tail_position - 1
+                lane.popleft()
+                next_lane.append(car)
+                self.position[car] = next_distance
+                self.lane[car] = k
+                self.hop[car] = hop + 1
+                self.done[car] = t
+                self.num_waiting -= 1
+                return True
+
+        # 过不了路口 (本时间片可行驶距离不够, 或下一条道路已满), 停在路口
+        self.position[car] = self.length[road_id]
+        self.done[car] = t
+        self.num_waiting -= 1
+        return True
+
+    def _start_off_cars(self):
+        t = self.current_time
+        while self.departure_queue and self.departure_queue[0][0] <= t:
+            heapq.heappush(self.garage, heapq.heappop(self.departure_queue)[1])
+
+        garage = []
+        while self.garage:
+            car = heapq.heappop(self.garage)
+            if not self._start_off(car):
+                garage.append(car)
+        self.garage = garage  # 按 id 升序取出, 本身就是一个堆
+
+    def _start_off(self, car):
+        road_id = self.routes[car][0]
+        distance = min(self.car_speed[car], self.road_speed[road_id], self.length[road_id])
+        for k, lane in enumerate(self.lanes[road_id]):
+            if lane:
+                tail_position = self.position[lane[-1]]
+                if tail_position <= distance:
+                    if tail_position == 1:
+                        continue
+                    distance = tail_position - 1
+            lane.append(car)
+            self.position[car] = distance
+            self.lane[car] = k
+            self.hop[car] = 0
+            self.done[car] = self.current_time
+            self.num_on_road += 1
+            return True
+        return False
+
+
+def replay(car_path, road_path, cross_path, answer_path, max_time=None, cache_dir=None):
+    replay_map = ReplayMap.from_files(car_path, road_path, cross_path, cache_dir)
+    start_times, routes = replay_map.read_answer(answer_path)
+    return Replay(replay_map, start_times, routes).run(max_time=max_time)
+
+
+# 批量评分时每个工作进程持有的地图, 由 _init_worker 设置.
+# fork 启动的进程直接继承父进程已经解析好的地图, 不必重新解析或拷贝
+_worker_map = None
+
+
+def _init_worker(replay_map):
+    global _worker_map
+    _worker_map = replay_map
+
+
+def _score_answer(answer_path, max_time):
+    try:
+        start_times, routes = _worker_map.read_answer(answer_path)
+        return answer_path, Replay(_worker_map, start_times, routes).run(max_time=max_time), None
+    except RuntimeError as e:  # 答案不合法, 记录原因, 不影响其他答案
+        return answer_path, None, str(e)
+    except (KeyError, ValueError) as e:
+        return answer_path, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def score_answers(car_path, road_path, cross_path, answer_paths, num_workers=None, max_time=None,
+                  cache_dir=None):
+    """用进程池回放多个候选答案, 地图只解析一次, 指定 cache_dir 时使用编译好的地图 (见 utc.compiled).
+
+    返回按答案顺序排列的 (答案路径, ReplayResult, 错误信息) 列表, 不合法的答案 ReplayResult 为 None.
+    """
+    replay_map = ReplayMap.from_files(car_path, road_path, cross_path, cache_dir)
+    if num_workers == 1 or len(answer_paths) <= 1:
+        _init_worker(replay_map)
+        return [_score_answer(answer_path, max_time) for answer_path in answer_paths]
+
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(replay_map,)) as pool:
+        return pool.starmap(_score_answer, [(answer_path, max_time) for answer_path in answer_paths])
+
+
+def format_scores(scores):
+    """评分表, 按官方排名排序: 没有死锁的在前, 其次系统调度时间, 再次总调度时间"""
+    def rank(score):
+        _, result, error = score
+        if result is None:
+            return (2, 0, 0)
+        return (int(result.deadlock), result.schedule_time, result.total_time)
+
+    lines = ['answer\tschedule_time\ttotal_time\tnum_arrived\tdeadlock\terror']
+    for answer_path, result, error in sorted(scores, key=rank):
+        if result is None:
+            lines.append('{}\t\t\t\t\t{}'.format(answer_path, error))
+        else:
+            lines.append('{}\t{}\t{}\t{}\t{}\t'.format(
+                answer_path, result.schedule_time, result.total_time, result.num_arrived, result.deadlock))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='按官方调度规则回放 answer.txt, 多个答案或目录时批量评分')
+    parser.add_argument('car_path')
+    parser.add_argument('road_path')
+    parser.add_argument('cross_path')
+    parser.add_argument('answer_paths', nargs='+', help='答案文件, 或包含若干 .txt 答案的目录')
+    parser.add_argument('--max-time', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None, help='进程数, 默认为 CPU 核数')
+    parser.add_argument('--map-cache', default=None, help='编译好的地图的缓存目录, 见 utc.compiled')
+    args = parser.parse_args()
+
+    answer_paths = []
+    for path in args.answer_paths:
+        if os.path.isdir(path):
+            answer_paths.extend(sorted(
+                os.path.join(path, fname) for fname in os.listdir(path) if fname.endswith('.txt')))
+        else:
+            answer_paths.append(path)
+
+    if len(answer_paths) == 1 and not os.path.isdir(args.answer_paths[0]):
+        print(replay(args.car_path, args.road_path, args.cross_path, answer_paths[0], max_time=args.max_time,
+                     cache_dir=args.map_cache))
+        return
+    scores = score_answers(args.car_path, args.road_path, args.cross_path, answer_paths,
+                           num_workers=args.workers, max_time=args.max_time, cache_dir=args.map_cache)
+    print(format_scores(scores))
+
+
+if __name__ == '__main__':
+    main()
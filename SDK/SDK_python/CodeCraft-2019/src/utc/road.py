@@ -1,7 +1,8 @@
 import logging
+from bisect import bisect_left, bisect_right, insort
 from math import floor
 
-from utc.car import CAR_STOP, CAR_RUNNING, CAR_TO_RUN
+from utc.car import CAR_STOP, CAR_RUNNING, CAR_TO_RUN, CAR_END
 
 BLOCKED = 0
 TO_BE_SCHEDULED = 1
@@ -10,43 +11,84 @@ DRIVEIN_ABLE = 2
 logger = logging.getLogger()
 
 
+class LanePositions(list):
+    """车道上的位置表, 下标 0 为靠近路口的位置, 元素为车辆或 None.
+
+    在 list 的基础上, 额外维护一个升序排列的已占用位置索引 occupied,
+    每次对某个位置赋值时同步更新. 这样查找前车/后车/末位车时只需二分查找,
+    不必再对整个车道切片反转扫描. 读取和赋值的方式与普通 list 完全一致.
+    末位车的位置发生变化时, 以剩余容量的变化量调用 tail_listener;
+    末位车被直接替换时, 变化量为 0.
+    """
+
+    def __init__(self, length, tail_listener=None):
+        super(LanePositions, self).__init__([None] * length)
+        self.occupied = []
+        self.tail_listener = tail_listener
+
+    def __setitem__(self, pos, car):
+        if isinstance(pos, slice):
+            raise TypeError('车道位置不支持切片赋值')
+        if pos < 0:
+            pos += len(self)
+        prev = list.__getitem__(self, pos)
+        list.__setitem__(self, pos, car)
+
+        occupied = self.occupied
+        if prev is not None and car is not None:
+            if pos == occupied[-1] and prev is not car and self.tail_listener is not None:
+                self.tail_listener(0)
+        elif prev is None and car is not None:
+            tail = occupied[-1] if occupied else -1
+            insort(occupied, pos)
+            if pos > tail and self.tail_listener is not None:
+                self.tail_listener(tail - pos)
+        elif prev is not None and car is None:
+            del occupied[bisect_left(occupied, pos)]
+            tail = occupied[-1] if occupied else -1
+            if pos > tail and self.tail_listener is not None:
+                self.tail_listener(pos - tail)
+
+
 class Lane(object):
-    def __init__(self, lane_id, length, speed):
+    def __init__(self, lane_id, length, speed, capacity_listener=None):
         super(Lane, self).__init__()
-        self.lane_id = str(lane_id)
+        self.lane_id = int(lane_id)  # 车道在道路内的序号, 从 0 开始
         self.capacity = int(length)  # remain capacity
         self.speed = int(speed)
 
-        self.positions = [None for _ in range(self.capacity)]
+        # 剩余容量随末位车的位置增量维护, 变化量再转告所在道路
+        self.current_capacity = self.capacity
+        self.capacity_listener = capacity_listener
+        self.positions = LanePositions(self.capacity, tail_listener=self._on_tail_change)
+
+    def _on_tail_change(self, delta):
+        self.current_capacity += delta
+        if self.capacity_listener is not None:
+            self.capacity_listener(delta)
 
     def find_last_drivein_position(self):
-        for i, state in enumerate(self.positions[::-1]):
-            if state is None:
-                continue
-            else:
-                return self.capacity - i
+        occupied = self.positions.occupied
+        if occupied:
+            return occupied[-1] + 1
         else:
             return 0
 
     def find_previous_car_position(self, pos):
         if pos == 0:
             return None
-        for i, state in enumerate(self.positions[:pos][::-1], 1):
-            if state is None:
-                continue
-            else:
-                return pos - i
+        i = bisect_left(self.positions.occupied, pos)
+        if i:
+            return self.positions.occupied[i-1]
         else:
             return None
 
     def find_next_car_position(self, pos):
         if pos == -1 or pos == self.capacity - 1:
             return None
-        for i, state in enumerate(self.positions[pos+1:], 0):
-            if state is None:
-                continue
-            else:
-                return pos + 1 + i
+        i = bisect_right(self.positions.occupied, pos)
+        if i < len(self.positions.occupied):
+            return self.positions.occupied[i]
         else:
             return None
 
@@ -54,7 +96,7 @@ class Lane(object):
         if last_drivein_position:
             return self.capacity - last_drivein_position
         else:
-            return self.capacity - self.find_last_drivein_position()
+            return self.current_capacity
     
     def get_last_car_current_speed(self):
         last_car_pos = self.find_last_drivein_position() - 1
@@ -76,31 +118,63 @@ class Lane(object):
 class Road(object):
     def __init__(
         self, road_id, length, highest_speed, num_lane,
-        start_cross_id, end_cross_id, capacity_threshold=0.0):
+        start_cross_id, end_cross_id, capacity_threshold=0.0, start_slot=-1, end_slot=-1):
         super(Road, self).__init__()
 
-        self.road_id = str(road_id)
+        # 有向道路的编号, 双向道路的两个方向编号分别为 2*i 与 2*i+1, i 为道路的内部编号
+        self.road_id = int(road_id)
+        self.base_road_id = self.road_id // 2
         self.length = int(length)
         self.num_lane = int(num_lane)
         self.highest_speed = int(highest_speed)
-        self.start_cross_id = str(start_cross_id)
-        self.end_cross_id = str(end_cross_id)
+        self.start_cross_id = int(start_cross_id)
+        self.end_cross_id = int(end_cross_id)
+        # 道路在起点/终点路口中的方向 (路口顺时针排列的第几条道路), 用于查路口的转向表
+        self.start_slot = int(start_slot)
+        self.end_slot = int(end_slot)
 
         self.max_capacity = self.length * self.num_lane
         self.block_capacity = floor(self.max_capacity * capacity_threshold)
+        self.current_capacity = self.max_capacity  # 各车道剩余容量之和, 由车道增量维护
+        self.capacity_listener = None  # 剩余容量变化时的回调, 由调度器挂载
+
+        # 道路状态的缓存, 只在剩余容量/末位车/末位车的状态变化时失效
+        self.current_state = None
+        self.state_listener = None  # 道路状态缓存失效时的回调, 由调度器挂载
 
+        # 过路口的优先级序列, 见 build_priority_cars
+        self.priority_cars = []
+        self.priority_start = 0
 
         self.init_lane()
 
 
     def init_lane(self):
         self.lanes = [
-            Lane(lane_id=self.road_id+'@'+str(n), length=self.length, speed=self.highest_speed)
-            for n in range(1, self.num_lane+1)
+            Lane(lane_id=n, length=self.length, speed=self.highest_speed,
+                 capacity_listener=self._on_lane_capacity_change)
+            for n in range(self.num_lane)
         ]
 
+    def _on_lane_capacity_change(self, delta):
+        self.current_capacity += delta
+        self.invalidate_state()
+        if self.capacity_listener is not None:
+            self.capacity_listener(delta)
+
+    def invalidate_state(self):
+        # 缓存本就失效时, 依赖它的缓存也早已失效, 不必再通知
+        if self.current_state is not None:
+            self.current_state = None
+            if self.state_listener is not None:
+                self.state_listener(self)
+
+    def depends_on_last_car_state(self):
+        """只有剩余容量不超过封锁容量时, 道路状态才取决于末位车的状态"""
+        return self.block_capacity >= self.current_capacity
+
     def get_current_capacity(self):
-        return sum([lane.get_current_capacity() for lane in self.lanes])
+        return self.current_capacity
 
     def allocate_lane(self):
         for lane in self.lanes:
@@ -109,7 +183,39 @@ class Road(object):
         else:
             None
 
+    def build_priority_cars(self):
+        """按过路口的优先级 (先距离路口的位置, 再车道) 排列道路上的全部车辆, 每个时间片开始时重建一次.
+
+        一个时间片内, 等待调度的车辆不会移动, 车辆一旦完成调度也不会再回到等待状态,
+        因此序列中等待调度的车辆始终保持这一相对顺序, 只需从头部跳过已完成调度的车辆.
+        """
+        self.priority_cars = [
+            lane.positions[pos]
+            for pos, lane_id, lane in sorted(
+                (pos, lane.lane_id, lane) for lane in self.lanes for pos in lane.positions.occupied)
+        ]
+        self.priority_start = 0
+
+    def get_priority_head(self):
+        """道路上优先级最高的等待调度车辆, 没有则返回 None"""
+        cars = self.priority_cars
+        i = self.priority_start
+        while i < len(cars) and cars[i].state in (CAR_STOP, CAR_END):
+            i += 1
+        self.priority_start = i
+        return cars[i] if i < len(cars) else None
+
+    def iter_priority_cars(self):
+        """从优先级最高的等待调度车辆开始遍历, 遍历过程中车辆可能完成调度, 由调用方自行跳过"""
+        self.get_priority_head()
+        return iter(self.priority_cars[self.priority_start:])
+
     def get_current_state(self):
+        if self.current_state is None:
+            self.current_state = self._compute_current_state()
+        return self.current_state
+
+    def _compute_current_state(self):
         if self.block_capacity >= self.get_current_capacity():
             lane_blocked = []
             for lane in self.lanes:
@@ -123,4 +229,4 @@ class Road(object):
             return DRIVEIN_ABLE
 
     def __repr__(self):
-        return self.road_id
\ No newline at end of file
+        return str(self.road_id)
\ No newline at end of file
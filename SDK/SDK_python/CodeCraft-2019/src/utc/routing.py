@@ -0,0 +1,424 @@
+import heapq
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import networkx as nx
+
+from utc.compiled import NO_TURN, TURN_LEFT, GO_STRAIGHT, TURN_RIGHT
+from utc.cross import TURN2PASS_WAY
+
+# 道路的权相对上次建树时的变化超过这一比例, 才让已建好的最短路径树失效
+TREE_TOLERANCE = 0.2
+ROUTE_CACHE_SIZE = 4096      # 路线缓存的条目数上限, 超出时淘汰最久未用的
+ROUTE_CACHE_TOLERANCE = 0.0  # 缓存的路线耗时比缓存时增加不超过这一比例, 仍可复用
+ROUTE_TABLE_TOLERANCE = 0.2   # 道路的权相对全源表所用的权变化超过这一比例, 才修补全源表
+ROUTE_TABLE_MAX_REPAIRS = 32  # 每个时间片最多修补的道路数, 其余的留到下个时间片或整表重算
+ROUTE_TABLE_MAX_ROWS = 64     # 每个时间片最多重算的行数 (每行一次 Dijkstra)
+
+
+class DestinationTrees(object):
+    """以终点路口为根的反向最短路径树, 同一终点的车辆共用一棵树, 由树读出路线只需 O(路线长度).
+
+    树在第一次用到时才建 (反向图上的一次 Dijkstra), 道路的权变化超过 tolerance 后整体失效,
+    下次用到时再按当时的路权重建. 容差以内的变化不重建, 所以读出的路线可能略微过时.
+    """
+
+    def __init__(self, roadnet, tolerance=TREE_TOLERANCE):
+        super(DestinationTrees, self).__init__()
+        self.roadnet = roadnet
+        self.reverse_roadnet = roadnet.reverse(copy=False)  # 视图, 随 roadnet 变化
+        self.tolerance = tolerance
+        self.trees = {}         # 终点路口 -> (到终点的耗时, 下一个路口)
+        # 有树以后变化过的道路, 在各棵树建树时的权的 (最小值, 最大值), (起点路口, 终点路口) -> (权, 权).
+        # 没有变化过的道路在各棵树建树时的权都相同, 不必记录
+        self.built_weights = {}
+
+    def clear(self):
+        self.trees.clear()
+        self.built_weights.clear()
+
+    def snapshot(self):
+        """树不进快照 (全部的树共 O(路口数²), 检查点会随之膨胀): 快照时清空, 回滚后同样从空树开始,
+        按相同的路权建出相同的树, 两次调度的结果仍然一致"""
+        self.clear()
+        return None
+
+    def restore(self, state):
+        self.clear()
+
+    def on_weight_change(self, start_cross_id, end_cross_id, old_weight, new_weight):
+        """道路的权从 old_weight 变为 new_weight, 由调度器在修改 roadnet 时调用"""
+        if not self.trees:
+            return
+        low, high = self.built_weights.setdefault((start_cross_id, end_cross_id), (old_weight, old_weight))
+        # 与各棵树建树时的权比较, 偏差最大的一定是最小或最大的那个
+        if abs(new_weight - low) > self.tolerance * low or abs(new_weight - high) > self.tolerance * high:
+            self.clear()
+
+    def get_tree(self, end_cross_id):
+        tree = self.trees.get(end_cross_id)
+        if tree is None:
+            pred, times = nx.dijkstra_predecessor_and_distance(self.reverse_roadnet, end_cross_id, weight='weight')
+            # 反向图上的前驱即正向的下一个路口, 等长的多条路线取第一条
+            next_crosses = {cross_id: crosses[0] for cross_id, crosses in pred.items() if crosses}
+            tree = (times, next_crosses)
+            self.trees[end_cross_id] = tree
+            for edge, (low, high) in self.built_weights.items():
+                weight = self.roadnet[edge[0]][edge[1]]['weight']
+                self.built_weights[edge] = (min(low, weight), max(high, weight))
+        return tree
+
+    def get_path(self, start_cross_id, end_cross_id):
+        """起点到终点的最短路线 (路口序列), 不可达时抛出 nx.NetworkXNoPath"""
+        times, next_crosses = self.get_tree(end_cross_id)
+        if start_cross_id not in times:
+            raise nx.NetworkXNoPath('路口{}无法到达路口{}'.format(start_cross_id, end_cross_id))
+        path = [start_cross_id]
+        while path[-1] != end_cross_id:
+            path.append(next_crosses[path[-1]])
+        return path
+
+    def get_time(self, start_cross_id, end_cross_id):
+        """建树时起点到终点的最短耗时, 不可达时返回 None"""
+        return self.get_tree(end_cross_id)[0].get(start_cross_id)
+
+    def get_first_hops(self, start_cross_id, end_cross_id):
+        """从起点路口驶出的每条道路, 先走这条道路再沿最短路线到终点的耗时, [(下一个路口, 耗时), ...].
+
+        只需终点的一棵树, 再对每个相邻路口松弛一次. 道路用当前的路权, 之后的路线用建树时的耗时.
+        相邻路口的最短路线又经过起点的 (掉头或绕回), 不是一条合法的路线, 不计入.
+        """
+        times, next_crosses = self.get_tree(end_cross_id)
+        hops = []
+        for cross_id, edge in self.roadnet[start_cross_id].items():
+            if cross_id not in times:
+                continue
+            path_cross_id = cross_id
+            while path_cross_id != end_cross_id and path_cross_id != start_cross_id:
+                path_cross_id = next_crosses[path_cross_id]
+            if path_cross_id == start_cross_id:
+                continue
+            hops.append((cross_id, edge['weight'] + times[cross_id]))
+        return hops
+
+
+class RouteCache(object):
+    """(起点路口, 终点路口, 约束) -> (路线, 耗时) 的 LRU 缓存. 约束如不可掉头回到的路口.
+
+    路权由调度器维护版本: 全局的 epoch 在任何一条道路的权变化时加一, 每条道路 (起点路口, 终点路口)
+    另有自己的变化次数. 条目记录缓存时的 epoch 与路线上各道路的变化次数, 复用前依次检查:
+        * epoch 未变: 路网没有任何变化, 直接复用
+        * 路线上的道路都没有变化: 路线耗时不变, 直接复用
+        * 否则沿路线重新累加路权, 耗时增加不超过 tolerance 时复用, 并以当前的版本刷新条目
+    路线以外的道路变快时条目不会失效, 这是以少量的最优性换取命中率. 各条目按不同时刻的路权算出,
+    连起来可能绕成环, 因此复用前还要核对路线不再经过车辆走过的路口 (avoid), 绕回去的条目丢弃重算.
+    """
+
+    def __init__(self, maxsize=ROUTE_CACHE_SIZE, tolerance=ROUTE_CACHE_TOLERANCE):
+        super(RouteCache, self).__init__()
+        self.maxsize = maxsize
+        self.tolerance = tolerance
+        # key -> [路线, 缓存时的耗时, 最近一次核对的耗时, 核对时的 epoch, 核对时路线上各道路的变化次数]
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def snapshot(self):
+        # 条目中的路线与版本列表只会被整体替换, 拷贝每个条目本身即可
+        return OrderedDict((key, list(entry)) for key, entry in self.entries.items())
+
+    def restore(self, state):
+        self.entries = OrderedDict((key, list(entry)) for key, entry in state.items())
+
+    def get(self, key, roadnet, epoch, edge_versions, avoid=()):
+        """命中时返回 (路线, 当前耗时), 否则返回 None. 路线 (起点以外) 经过 avoid 中的路口时不复用"""
+        entry = self.entries.get(key)
+        if entry is not None and len(avoid) and np.isin(entry[0][1:], avoid).any():
+            del self.entries[key]
+            entry = None
+        if entry is not None:
+            path, base_time, path_time, entry_epoch, versions = entry
+            if entry_epoch != epoch:
+                edges = list(zip(path[:-1], path[1:]))
+                current_versions = [edge_versions[edge] for edge in edges]
+                if current_versions != versions:
+                    path_time = sum(roadnet[s][e]['weight'] for s, e in edges)
+                    if path_time > base_time * (1 + self.tolerance):
+                        del self.entries[key]
+                        self.misses += 1
+                        return None
+                entry[2:] = [path_time, epoch, current_versions]
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return path, path_time
+        self.misses += 1
+        return None
+
+    def put(self, key, path, path_time, epoch, edge_versions):
+        versions = [edge_versions[edge] for edge in zip(path[:-1], path[1:])]
+        self.entries[key] = [path, path_time, path_time, epoch, versions]
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class TurnGraph(object):
+    """以有向道路为结点的路网 (线图), 只有路口允许的转向 (Cross.turns) 才连边, 掉头天然走不通.
+
+    每个路口另有一个终点结点 ('to', cross_id), 驶入该路口的道路都连向它, 查询时以它为目标.
+    边权在查询时才计算: 驶入道路的当前路权 (由 road_weight 给出) 加上转向的惩罚,
+    因此路权变化时不必更新线图. turn_penalties 形如 {'turn_left': 1.0, 'turn_right': 2.0}, 缺省的转向不加惩罚.
+    """
+
+    def __init__(self, crosses, roads, road_weight, turn_penalties=None):
+        super(TurnGraph, self).__init__()
+        self.roads = roads  # 有向道路编号 -> Road
+        self.road_weight = road_weight
+        self.turn_penalties = dict(turn_penalties or {})
+
+        self.graph = nx.DiGraph()
+        self.graph.add_nodes_from(roads)
+        for cross in crosses:
+            # 驶入/驶出路口的有向道路, 按在路口中的方向排列, 没有道路为 -1
+            in_roads = cross.in_roads.tolist()
+            out_roads = [-1] * 4
+            for road_id in cross.adj_roads.tolist():
+                out_roads[roads[road_id].start_slot] = road_id
+            for i in range(4):
+                for turn in (TURN_LEFT, GO_STRAIGHT, TURN_RIGHT):
+                    j = (i + turn) % 4
+                    if cross.turns[i, j] == NO_TURN:
+                        continue
+                    pass_way = TURN2PASS_WAY[turn]
+                    self.graph.add_edge(in_roads[i], out_roads[j], penalty=self.turn_penalties.get(pass_way, 0))
+            for road_id in sorted(road_id for road_id in in_roads if road_id != -1):
+                self.graph.add_edge(road_id, ('to', cross.cross_id), penalty=0)
+
+    def _weight(self, u, v, data):
+        if isinstance(v, tuple):  # 到达终点路口
+            return 0
+        return self.road_weight(self.roads[v]) + data['penalty']
+
+    def get_path(self, road, end_cross_id):
+        """车辆行驶在 road 上, 到终点路口的最短合法路线 (路口序列, 从 road 的终点路口开始).
+        一次 Dijkstra 即可, 不可达时抛出 nx.NetworkXNoPath"""
+        road_ids = nx.dijkstra_path(self.graph, road.road_id, ('to', end_cross_id), weight=self._weight)
+        return [road.end_cross_id] + [self.roads[road_id].end_cross_id for road_id in road_ids[1:-1]]
+
+
+def all_pairs_shortest_paths(weights, deadline=None):
+    """Floyd-Warshall, 按中转路口逐个以整个矩阵的向量运算松弛, O(C^3) 次运算但只有 C 次 Python 循环.
+
+    weights[i, j] 为路口 i 到 j 的道路的权, 没有道路为 inf. 返回 (耗时矩阵, 下一个路口矩阵), 不可达的下一个路口为 -1.
+    过了 deadline (time.time()) 还没算完时抛出 RuntimeError.
+    """
+    num_crosses = len(weights)
+    cross_ids = np.arange(num_crosses)
+    times = weights.copy()
+    times[cross_ids, cross_ids] = 0
+    next_crosses = np.where(np.isfinite(weights), cross_ids[None, :], -1).astype(np.int32)
+    next_crosses[cross_ids, cross_ids] = cross_ids
+    for k in range(num_crosses):
+        if deadline is not None and time.time() > deadline:
+            raise RuntimeError('全源最短路算到第{}个中转路口时已到截止时间'.format(k))
+        via = times[:, k, None] + times[None, k, :]
+        better = via < times
+        np.copyto(times, via, where=better)
+        np.copyto(next_crosses, next_crosses[:, k, None], where=better)
+    return times, next_crosses
+
+
+class RouteTable(object):
+    """全源最短路的稠密矩阵, 任意两个路口间的最短耗时与下一个路口都是 O(1) 查表, 接口同 DestinationTrees.
+
+    路权变化时只记入 live_weights, 每个时间片开始时 (on_tick) 与表所用的权 table_weights 比较,
+    变化超过 tolerance 的道路才修补: 变快的道路对整个矩阵做一次向量化的松弛, 结果是精确的;
+    变慢的道路找出最短路线可能经过它的行, 逐行重算 Dijkstra. 每个时间片修补的道路数与重算的行数都有上限,
+    超出的留到之后. 另有后台线程每隔 interval 个时间片按当时的路权整表重算一次, 在下一个间隔点换上,
+    换表的时间片是固定的, 因此调度结果与线程的快慢无关. 用完后调用 close 结束后台线程.
+
+    构造时的整表计算为 O(C^3), 过了 deadline 还没算完时抛出 RuntimeError.
+    """
+
+    def __init__(self, roadnet, interval=None, tolerance=ROUTE_TABLE_TOLERANCE,
+                 max_repairs=ROUTE_TABLE_MAX_REPAIRS, max_rows=ROUTE_TABLE_MAX_ROWS, deadline=None):
+        super(RouteTable, self).__init__()
+        self.roadnet = roadnet
+        self.interval = interval
+        self.tolerance = tolerance
+        self.max_repairs = max_repairs
+        self.max_rows = max_rows
+
+        num_crosses = roadnet.number_of_nodes()
+        self.live_weights = np.full((num_crosses, num_crosses), np.inf)
+        for s, e, weight in roadnet.edges(data='weight'):
+            self.live_weights[s, e] = weight
+        self.edges = np.array(list(roadnet.edges()), dtype=np.int64).reshape(-1, 2)
+        self.out_crosses = [list(roadnet[cross_id]) for cross_id in range(num_crosses)]
+
+        self.table_weights = self.live_weights.copy()
+        self.times, self.next_crosses = all_pairs_shortest_paths(self.table_weights, deadline)
+
+        self.executor = ThreadPoolExecutor(max_workers=1) if interval else None
+        self.recompute = None          # 后台整表重算的 Future, 结果为 (耗时矩阵, 下一个路口矩阵)
+        self.recompute_weights = None  # 后台整表重算所用的权
+        self.next_swap_time = None     # 换上后台结果的时间片
+
+    def close(self):
+        """结束后台线程, 正在进行的重算不再等待"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.recompute = None
+
+    def clear(self):
+        self.table_weights = self.live_weights.copy()
+        self.times, self.next_crosses = all_pairs_shortest_paths(self.table_weights)
+
+    def snapshot(self):
+        # 后台重算只由所用的权决定, 保存权即可, 不必等它算完; 回滚后按同样的权重算, 在同一个时间片换上.
+        # 换表后这份权就是 table_weights, 会被 repair 改写, 因此要拷贝
+        recompute_weights = None if self.recompute_weights is None else self.recompute_weights.copy()
+        return (self.live_weights.copy(), self.table_weights.copy(), self.times.copy(), self.next_crosses.copy(),
+                recompute_weights, self.next_swap_time)
+
+    def restore(self, state):
+        live_weights, table_weights, times, next_crosses, recompute_weights, next_swap_time = state
+        self.live_weights = live_weights.copy()
+        self.table_weights = table_weights.copy()
+        self.times = times.copy()
+        self.next_crosses = next_crosses.copy()
+        self._submit(None if recompute_weights is None else recompute_weights.copy())
+        self.next_swap_time = next_swap_time
+
+    def _submit(self, weights):
+        """后台按 weights 整表重算, weights 提交后不再修改. close 之后再提交时重新启动后台线程"""
+        self.recompute_weights = weights
+        self.recompute = None
+        if weights is not None:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+            self.recompute = self.executor.submit(all_pairs_shortest_paths, weights)
+
+    def on_weight_change(self, start_cross_id, end_cross_id, old_weight, new_weight):
+        self.live_weights[start_cross_id, end_cross_id] = new_weight
+
+    def on_tick(self, current_time):
+        """每个时间片开始时调用: 到了间隔点就换上后台的结果并开始下一次重算, 再修补变化较大的道路"""
+        if self.interval and (self.next_swap_time is None or current_time >= self.next_swap_time):
+            if self.recompute is not None:
+                self.times, self.next_crosses = self.recompute.result()
+                self.table_weights = self.recompute_weights
+            self._submit(self.live_weights.copy())
+            self.next_swap_time = current_time + self.interval
+        self.repair()
+
+    def repair(self):
+        s, e = self.edges[:, 0], self.edges[:, 1]
+        live, table = self.live_weights[s, e], self.table_weights[s, e]
+        change = np.abs(live - table) / table
+        changed = np.flatnonzero(change > self.tolerance)
+        changed = changed[np.argsort(-change[changed], kind='stable')][:self.max_repairs]
+
+        # 先找出变慢的道路影响的行 (用修补前的矩阵), 超出行数上限的道路留到之后
+        rows = set()
+        repaired = []
+        for i in changed.tolist():
+            u, v = int(s[i]), int(e[i])
+            if live[i] > table[i]:
+                via = self.times[:, u, None] + table[i] + self.times[None, v, :]
+                affected = np.flatnonzero((np.isclose(via, self.times) & np.isfinite(self.times)).any(axis=1))
+                if len(rows.union(affected.tolist())) > self.max_rows:
+                    continue
+                rows.update(affected.tolist())
+            repaired.append((u, v, table[i], live[i]))
+            self.table_weights[u, v] = live[i]
+
+        for row in sorted(rows):
+            self.times[row], self.next_crosses[row] = self._dijkstra(row)[:2]
+        for u, v, old_weight, weight in repaired:
+            if weight < old_weight:
+                self._relax(u, v, weight)
+
+    def _relax(self, u, v, weight):
+        """道路 u->v 变快, 所有经过它更近的路口对改走它"""
+        via = self.times[:, u, None] + weight + self.times[None, v, :]
+        better = via < self.times
+        first_crosses = self.next_crosses[:, u].copy()
+        first_crosses[u] = v  # 从 u 出发, 第一步就是这条道路
+        np.copyto(self.times, via, where=better)
+        np.copyto(self.next_crosses, first_crosses[:, None], where=better)
+
+    def _dijkstra(self, source):
+        """以表所用的权从 source 出发的 Dijkstra, 返回 (耗时, 第一步到达的路口, 前驱) 三个数组"""
+        num_crosses = len(self.times)
+        times = np.full(num_crosses, np.inf)
+        first_crosses = np.full(num_crosses, -1, dtype=np.int32)
+        parents = np.full(num_crosses, -1, dtype=np.int32)
+        times[source] = 0
+        first_crosses[source] = source
+        heap = [(0.0, source)]
+        done = set()
+        while heap:
+            time_u, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            done.add(u)
+            for v in self.out_crosses[u]:
+                time_v = time_u + self.table_weights[u, v]
+                if time_v < times[v]:
+                    times[v] = time_v
+                    first_crosses[v] = v if u == source else first_crosses[u]
+                    parents[v] = u
+                    heapq.heappush(heap, (time_v, v))
+        return times, first_crosses, parents
+
+    def get_path(self, start_cross_id, end_cross_id):
+        """查表读出最短路线, 不可达时抛出 nx.NetworkXNoPath.
+        各行修补的时机不同, 逐行读出的路线可能绕成环, 这时改用起点的一次 Dijkstra"""
+        if self.next_crosses[start_cross_id, end_cross_id] == -1:
+            raise nx.NetworkXNoPath('路口{}无法到达路口{}'.format(start_cross_id, end_cross_id))
+        path = [start_cross_id]
+        while path[-1] != end_cross_id:
+            next_cross_id = int(self.next_crosses[path[-1], end_cross_id])
+            if next_cross_id == -1 or len(path) > len(self.times):
+                break
+            path.append(next_cross_id)
+        else:
+            return path
+
+        parents = self._dijkstra(start_cross_id)[2]
+        path = [end_cross_id]
+        while path[-1] != start_cross_id:
+            path.append(int(parents[path[-1]]))
+        return path[::-1]
+
+    def get_time(self, start_cross_id, end_cross_id):
+        path_time = self.times[start_cross_id, end_cross_id]
+        return float(path_time) if np.isfinite(path_time) else None
+
+    def get_first_hops(self, start_cross_id, end_cross_id):
+        """同 DestinationTrees.get_first_hops, 相邻路口之后的路线逐行查表; 查出的路线绕成环的也不计入"""
+        hops = []
+        for cross_id, edge in self.roadnet[start_cross_id].items():
+            path_time = self.times[cross_id, end_cross_id]
+            if not np.isfinite(path_time):
+                continue
+            path_cross_id, num_hops = cross_id, 0
+            while path_cross_id not in (end_cross_id, start_cross_id, -1) and num_hops < len(self.times):
+                path_cross_id = int(self.next_crosses[path_cross_id, end_cross_id])
+                num_hops += 1
+            if path_cross_id != end_cross_id:
+                continue
+            hops.append((cross_id, edge['weight'] + float(path_time)))
+        return hops
@@ -3,11 +3,11 @@ import sys
 import logging
 import copy
 import random
-import multiprocessing
+import heapq
+import time
+import pickle
 from math import floor
-from queue import Queue
 from collections import OrderedDict, defaultdict
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 import numpy as np
@@ -15,39 +15,72 @@ import numpy as np
 import networkx as nx
 from utc.road import DRIVEIN_ABLE, BLOCKED, TO_BE_SCHEDULED
 from utc.car import CAR_TO_RUN, CAR_RUNNING, CAR_STOP, CAR_END
+from utc.kernel import move_cars_on_the_same_way
+from utc.routing import DestinationTrees, RouteCache, RouteTable, TurnGraph
 
 
 logger = logging.getLogger()
 
+# 路线规划的方式, 随截止时间临近逐级降级 (见 Scheduler._update_routing_mode)
+ROUTING_EXPLORE = 0   # 探索多条候选路线 (上路时的备选道路, 见 _choose_a_road_to_run)
+ROUTING_CACHED = 1    # 路上车辆只走缓存的最短路线 (上路前的路线本来就查树, 不受影响)
+ROUTING_FALLBACK = 2  # 不再模拟, 剩余车辆沿最短路线错峰出发
+CACHED_ROUTING_RATIO = 0.5  # 剩余时间不足总预算的这一比例时, 改用缓存的最短路线
+FALLBACK_RATIO = 0.1        # 剩余时间不足总预算的这一比例时, 放弃模拟
+PATH_CACHE_TTL = 10         # 最短路线缓存的有效时间片数, 路权在变, 过期重算
+
+
+class DeadlockError(RuntimeError):
+    """路网锁死, 由 Scheduler._report_deadlock 抛出"""
+    pass
+
 
 # TODO: 1. 所有的检查项都注释掉
 
 class Scheduler(object):
 
-    def __init__(self, crosses, roads, cars, capacity_threshold=0.9, num_cars_on_road=128):
-        """根据路口和道路, 保存了几乎所有的静态量.
+    def __init__(self, crosses, roads, cars, capacity_threshold=0.9, num_cars_on_road=128,
+                 vectorized_phase1=True, prob4ideal_path=0.5,
+                 deadline=None, turn_penalties=None, route_table_interval=None):
+        """根据路口和道路, 保存了几乎所有的静态量. cars 为 utc.fleet.Fleet.
+        vectorized_phase1 为 True 时, 第一步调度使用批量的 NumPy 实现 (见 utc.kernel).
+        prob4ideal_path 是车辆上路时走最优道路的概率, 见 _choose_a_road_to_run.
+        deadline 为必须结束调度的时刻 (time.time()), 临近时路线规划逐级降级, 保证按时给出答案.
+        turn_penalties 为路上车辆规划路线时各转向额外的耗时, 如 {'turn_left': 1.0}, 见 utc.routing.TurnGraph.
+        route_table_interval 不为 None 时, 最短路线改由全源的 utc.routing.RouteTable 查表给出,
+        后台每隔这么多个时间片整表重算一次 (0 为不重算, 只做增量修补); 默认按终点建反向最短路径树.
+        全源表在 deadline 之前来不及建好时也改用最短路径树. 用完全源表后应调用 close.
         路口肯定是不变的, 道路的长度, 限速都是不变的, 变化的包括:
             * 每条车道上的车辆数, 决定了可进入的车辆数
             * 每条车道上最后一辆车的速度, 决定了可进入的车速
         """
 
+        # 路网的边直接取自编译好的邻接表 (见 utc.compiled), 不必再由道路推出
+        road_weights = {road.road_id: road.length / road.highest_speed for road in roads}
         self.roadnet = nx.DiGraph()
         self.roadnet.add_nodes_from([cross.cross_id for cross in crosses])
         self.roadnet.add_edges_from([
-            (road.start_cross_id, road.end_cross_id, {'weight': road.length / road.highest_speed})
-            for road in roads
+            (cross.cross_id, end_cross_id, {'weight': road_weights[road_id]})
+            for cross in crosses
+            for road_id, end_cross_id in zip(cross.adj_roads.tolist(), cross.adj_crosses.tolist())
         ])
         self.cars_to_run = {car.car_id: car for car in cars}   # 待上路车辆
         self.running_cars = {}    # 路上车辆
+        self.waiting_cars = set() # 路上尚未完成本时间片调度的车辆 (状态不是 CAR_STOP), 随车辆状态变更实时维护
         self.ended_cars = {}      # 结束车辆
         self.crosses = OrderedDict([
             (cross.cross_id, cross)
-            for cross in sorted(crosses, key=lambda c: int(c.cross_id))
+            for cross in sorted(crosses, key=lambda c: c.cross_id)
         ])
         self.roads = OrderedDict([
             (road.road_id, road)
-            for road in sorted(roads, key=lambda r: int(r.road_id[:r.road_id.find('#')]))
+            for road in sorted(roads, key=lambda r: r.base_road_id)
         ])
+        # 车辆状态保存在 fleet 中, 车辆的道路以编号保存, 需要道路表还原
+        self.fleet = cars
+        self.fleet.bind_roads(self.roads)
+        self.fleet.state_listener = self._on_car_state_change
+
         # 根据两端的路口确定道路, 路口顺序不可颠倒
         self.cross_pair_to_road = {(road.start_cross_id, road.end_cross_id): road for road in self.roads.values()}
 
@@ -58,28 +91,109 @@ class Scheduler(object):
 
         self.current_time = 0
         self.max_roadnet_capacity = sum([road.max_capacity for road in self.roads.values()])
+        # 路网的剩余容量, 随车辆进出车道增量维护
+        self.current_roadnet_capacity = sum([road.get_current_capacity() for road in self.roads.values()])
+        for road in self.roads.values():
+            road.capacity_listener = self._on_road_capacity_change
+            road.state_listener = self._on_road_state_invalidated
+        # 路口处驶入道路状态的汇总缓存, cross_id -> (道路数, 封锁的道路数, 可驶入的道路数)
+        self.cross_state_counts = {}
         self.block_roadnet_capacity = floor(self.max_roadnet_capacity * capacity_threshold)
         self.num_cars_on_road = num_cars_on_road
+        self.vectorized_phase1 = vectorized_phase1
+        self.prob4ideal_path = prob4ideal_path
+
+        self.start_wall_time = time.time()
+        self.deadline = deadline
+        self.routing_mode = ROUTING_EXPLORE
+        self.path_cache = {}  # 起点路口 -> {终点路口: 最短路线}, 每 PATH_CACHE_TTL 个时间片清空
+        self.path_cache_time = 0
+        # 最短路线: 以终点为根的最短路径树 (路权变化较大时失效), 或全源的最短路表 (增量修补, 后台定期重算).
+        # 全源表的构造是 O(C^3) 的, 到了路线规划要降级的时刻还没算完就改用最短路径树
+        self.route_table = None
+        if route_table_interval is not None:
+            explore_deadline = None
+            if deadline is not None:
+                explore_deadline = deadline - (deadline - self.start_wall_time) * CACHED_ROUTING_RATIO
+            try:
+                self.route_table = RouteTable(self.roadnet, interval=route_table_interval, deadline=explore_deadline)
+            except RuntimeError as e:
+                logger.info('第{t}个时间片调度\t{e}, 改用最短路径树'.format(t=self.current_time, e=e))
+        self.shortest_paths = self.route_table or DestinationTrees(self.roadnet)
+        # 路权的版本: 任何道路的权变化时 weight_epoch 加一, edge_versions 记录每条道路 (起点路口, 终点路口) 的变化次数
+        self.weight_epoch = 0
+        self.edge_versions = defaultdict(int)
+        # 路上车辆的路线缓存, (当前路口, 终点路口, 来时的路口) -> 路线, 复用前按路权的版本核对
+        self.route_cache = RouteCache()
+        # 以有向道路为结点, 只含合法转向的路网, 路上车辆不掉头的最短路线由此一次查出
+        self.turn_graph = TurnGraph(self.crosses.values(), self.roads, self._get_road_weight, turn_penalties)
+        self.last_tick_wall_time = 0.0  # 上一个时间片调度的耗时 (秒)
 
         self._arrange_cars_to_run()
 
+        # 发车索引: 按 (计划出发时间, 车辆 id) 排列的堆, 以及已到出发时间但还没能上路的车辆 id 堆
+        self.departure_queue = [(car.planned_departure_time, car.car_id) for car in self.cars_to_run.values()]
+        heapq.heapify(self.departure_queue)
+        self.deferred_cars = []
+
     def _send_run_signals(self, cars):
         for car in cars.values():
             car.state = CAR_TO_RUN
             car.pass_intention = None
             car.road_to_turn = None
     
+    def _on_car_state_change(self, car, state):
+        """车辆状态变更的回调, 维护 waiting_cars, 使终止条件的检查为 O(1)"""
+        if state == CAR_STOP or state == CAR_END:
+            self.waiting_cars.discard(car.car_id)
+        elif state is not None:  # 刚上路的车辆还没有状态, 下一个时间片收到行驶信号后才等待调度
+            self.waiting_cars.add(car.car_id)
+
+        # 末位车的状态可能决定道路的状态
+        road = car.on_road
+        if road is not None and road.depends_on_last_car_state():
+            road.invalidate_state()
+
+    def _on_road_state_invalidated(self, road):
+        # 道路只是其终点路口的驶入道路
+        self.cross_state_counts.pop(road.end_cross_id, None)
+
+    def _report_deadlock(self):
+        """一轮调度之后没有任何车辆完成调度, 说明路网已经锁死, 报告车辆的等待关系"""
+        cross2waiting_cars = defaultdict(list)
+        for car_id in self.waiting_cars:
+            car = self.running_cars[car_id]
+            cross2waiting_cars[car.start_cross_id].append(car_id)
+        for cross_id in sorted(cross2waiting_cars):
+            logger.error('第{t}个时间片调度\t路口{cross_id}处等待的车辆: {cars}'.format(
+                t=self.current_time, cross_id=cross_id,
+                cars=', '.join([str(car_id) for car_id in sorted(cross2waiting_cars[cross_id])])))
+        raise DeadlockError('第{t}个时间片调度, {n}辆车相互等待, 路网锁死'.format(
+            t=self.current_time, n=len(self.waiting_cars)))
+
+    def _on_road_capacity_change(self, delta):
+        self.current_roadnet_capacity += delta
+
     def _check_positions(self, cars):
         for car in cars.values():
             if car.state == CAR_END:
                 continue
-            road = self.roads.get(car.on_road)
-            lane = road.lanes[int(car.on_lane[car.on_lane.find('@')+1:])-1]
+            lane = car.on_lane
             assert lane.positions[car.on_position] == car, '{}, {} vs {}'.format(car.on_position, lane.positions[car.on_position], car)
 
     def schedule(self):
+        tick_start_wall_time = time.time()
+        self._update_routing_mode()
+        if self.routing_mode == ROUTING_FALLBACK:
+            self._finish_without_simulation()
+            return
+        self._skip_idle_time()
+        if self.route_table is not None:
+            self.route_table.on_tick(self.current_time)
+
         # step1, 调度路上车辆
         self._send_run_signals(self.running_cars)
+        self._build_priority_cars()
         self._schedule_running_cars()
         self._check_positions(self.running_cars)
 
@@ -89,6 +203,194 @@ class Scheduler(object):
 
         logger.info('第{t}个时间片调度\t调度完成'.format(t=self.current_time))
         self.current_time += 1
+        self.last_tick_wall_time = time.time() - tick_start_wall_time
+
+    def _update_routing_mode(self):
+        """根据剩余时间占总预算的比例, 决定路线规划的方式, 只会降级不会恢复.
+        剩余时间不够再调度两个时间片 (以上一个时间片的耗时估计) 时也放弃模拟"""
+        if self.deadline is None:
+            return
+        budget = self.deadline - self.start_wall_time
+        time_left = self.deadline - time.time()
+        if time_left < max(budget * FALLBACK_RATIO, 2 * self.last_tick_wall_time):
+            routing_mode = ROUTING_FALLBACK
+        elif time_left < budget * CACHED_ROUTING_RATIO:
+            routing_mode = ROUTING_CACHED
+        else:
+            routing_mode = ROUTING_EXPLORE
+        if routing_mode > self.routing_mode:
+            logger.info('第{t}个时间片调度\t剩余时间{s:.1f}秒, 路线规划降级为{m}'.format(
+                t=self.current_time, s=time_left, m=routing_mode))
+            self.routing_mode = routing_mode
+
+    def _get_shortest_path_tree(self, start_cross_id):
+        """以起点路口为根的最短路径树 (距离, 路线) 整棵缓存, 同一起点的车辆共用一次 Dijkstra"""
+        if self.current_time >= self.path_cache_time + PATH_CACHE_TTL:
+            self.path_cache.clear()
+            self.path_cache_time = self.current_time
+        tree = self.path_cache.get(start_cross_id)
+        if tree is None:
+            tree = nx.single_source_dijkstra(self.roadnet, start_cross_id, weight='weight')
+            self.path_cache[start_cross_id] = tree
+        return tree
+
+    def _get_cached_path(self, start_cross_id, end_cross_id, previous_cross_id=None):
+        """缓存的最短路线. 给出来时的路口时不掉头: 最短路线要掉头的, 改走其他相邻路口中总耗时最短的一条.
+        找不到不掉头的路线时返回 None"""
+        path = self._get_shortest_path_tree(start_cross_id)[1][end_cross_id]
+        if previous_cross_id is None or len(path) == 1 or path[1] != previous_cross_id:
+            return path
+
+        best_path, best_time = None, None
+        for cross_id, edge in self.roadnet[start_cross_id].items():
+            if cross_id == previous_cross_id:
+                continue
+            times, paths = self._get_shortest_path_tree(cross_id)
+            if end_cross_id not in paths:
+                continue
+            path = paths[end_cross_id]
+            if len(path) > 1 and path[1] == start_cross_id:
+                continue  # 到了相邻路口又要掉头
+            path_time = edge['weight'] + times[end_cross_id]
+            if best_time is None or path_time < best_time:
+                best_path, best_time = [start_cross_id] + path, path_time
+        return best_path
+
+    def _finish_without_simulation(self):
+        """来不及模拟了: 路上的车辆沿最短路线开到终点, 车库中的车辆按路网已有的发车速度错峰出发.
+
+        答案不再经过模拟, 质量没有保证, 但一定完整."""
+        num_started = len(self.running_cars) + len(self.ended_cars)
+        rate = max(1, num_started // max(1, self.current_time))  # 平均每个时间片上路的车辆数
+        logger.info('第{t}个时间片调度\t放弃模拟, {n}辆车按每个时间片{r}辆错峰出发'.format(
+            t=self.current_time, n=len(self.cars_to_run), r=rate))
+
+        for car in self.running_cars.values():
+            if car.start_cross_id == car.end_cross_id:
+                continue
+            self._make_plan_for_running_car(car)
+            self._append_path_to_route(car, car.ideal_path)
+
+        cars_to_run = sorted(self.cars_to_run.values(), key=lambda car: (car.planned_departure_time, car.car_id))
+        for i, car in enumerate(cars_to_run):
+            car.departure_time = max(car.planned_departure_time, self.current_time + i // rate)
+            self._append_path_to_route(car, self._get_cached_path(car.start_cross_id, car.end_cross_id))
+
+        self.ended_cars.update(self.running_cars)
+        self.ended_cars.update(self.cars_to_run)
+        self.running_cars = {}
+        self.cars_to_run = OrderedDict()
+
+    def _append_path_to_route(self, car, path):
+        for start_cross_id, end_cross_id in zip(path[:-1], path[1:]):
+            road = self.cross_pair_to_road[(start_cross_id, end_cross_id)]
+            self.fleet.append_route(car.car_id, road.road_id, road.start_cross_id)
+
+    def _skip_idle_time(self):
+        """路上没有车辆, 也没有已到出发时间的车辆时, 中间的时间片什么也不会发生, 直接跳到下一个计划出发时间"""
+        if self.running_cars or self.deferred_cars or not self.departure_queue:
+            return
+        next_departure_time = self.departure_queue[0][0]
+        if next_departure_time > self.current_time:
+            logger.info('第{t}个时间片调度\t路网空闲, 跳到第{n}个时间片'.format(
+                t=self.current_time, n=next_departure_time))
+            self.current_time = next_departure_time
+
+    def snapshot(self):
+        """保存两个时间片之间的全部可变状态, 用于向前模拟若干个时间片再回滚 (见 restore).
+
+        车辆状态是 Fleet 中若干数组的拷贝, 车道上的车辆由车辆的 on_road/on_lane/on_position 还原,
+        道路/路口的状态缓存与剩余容量都可以由车道重建, 因此不必保存道路与车道对象.
+        随机数发生器的状态一并保存, 回滚后再次调度的结果与第一次完全一致.
+        最短路径树不保存, 快照时即清空, 之后两次调度都从空树开始重建 (见 utc.routing.DestinationTrees.snapshot).
+        """
+        return {
+            'current_time': self.current_time,
+            'fleet': self.fleet.snapshot(),
+            'cars_to_run': self.cars_to_run.copy(),
+            'running_cars': self.running_cars.copy(),
+            'ended_cars': self.ended_cars.copy(),
+            'waiting_cars': set(self.waiting_cars),
+            'departure_queue': list(self.departure_queue),
+            'deferred_cars': list(self.deferred_cars),
+            'current_roadnet_capacity': self.current_roadnet_capacity,
+            'weights': [(s, e, data['weight']) for s, e, data in self.roadnet.edges(data=True)],
+            'weight_epoch': self.weight_epoch,
+            'edge_versions': dict(self.edge_versions),
+            'shortest_paths': self.shortest_paths.snapshot(),
+            'route_cache': self.route_cache.snapshot(),
+            'random_state': random.getstate(),
+            'np_random_state': np.random.get_state(),
+        }
+
+    def restore(self, snapshot):
+        """回滚到 snapshot 时的状态, 同一个快照可以多次回滚"""
+        # 先清空车道, 再按车辆的位置放回, 车道与道路的剩余容量随之增量恢复
+        for road in self.roads.values():
+            for lane in road.lanes:
+                positions = lane.positions
+                while positions.occupied:
+                    positions[positions.occupied[-1]] = None
+
+        fleet = self.fleet
+        fleet.restore(snapshot['fleet'])
+        self.current_time = snapshot['current_time']
+        self.cars_to_run = snapshot['cars_to_run'].copy()
+        self.running_cars = snapshot['running_cars'].copy()
+        self.ended_cars = snapshot['ended_cars'].copy()
+        self.waiting_cars = set(snapshot['waiting_cars'])
+        self.departure_queue = list(snapshot['departure_queue'])
+        self.deferred_cars = list(snapshot['deferred_cars'])
+
+        for car_id, car in self.running_cars.items():
+            lane = fleet.roads[fleet.on_road[car_id]].lanes[fleet.on_lane[car_id]]
+            lane.positions[int(fleet.on_position[car_id])] = car
+        self.current_roadnet_capacity = snapshot['current_roadnet_capacity']
+
+        for s, e, weight in snapshot['weights']:
+            self.roadnet[s][e]['weight'] = weight
+        # 车辆状态是直接写回数组的, 没有经过监听, 缓存全部作废
+        for road in self.roads.values():
+            road.current_state = None
+        self.cross_state_counts.clear()
+        self.path_cache.clear()
+        # 路线相关的缓存依赖于当时的路权, 与路权一同回滚
+        self.weight_epoch = snapshot['weight_epoch']
+        self.edge_versions = defaultdict(int, snapshot['edge_versions'])
+        self.shortest_paths.restore(snapshot['shortest_paths'])
+        self.route_cache.restore(snapshot['route_cache'])
+
+        random.setstate(snapshot['random_state'])
+        np.random.set_state(snapshot['np_random_state'])
+
+    def save_checkpoint(self, path):
+        """将 snapshot 写入文件, 车辆以 car_id 保存. 先写临时文件再替换, 中途崩溃不会留下损坏的检查点"""
+        snapshot = self.snapshot()
+        for name in ('cars_to_run', 'running_cars', 'ended_cars'):
+            snapshot[name] = list(snapshot[name].keys())
+        snapshot['num_cars'] = len(self.fleet)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump(snapshot, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path):
+        """从 save_checkpoint 写入的文件恢复, 调度器需由同一份地图构造"""
+        with open(path, 'rb') as fin:
+            snapshot = pickle.load(fin)
+        if snapshot['num_cars'] != len(self.fleet):
+            raise RuntimeError('检查点有{}辆车, 与当前地图的{}辆车不一致'.format(snapshot['num_cars'], len(self.fleet)))
+
+        id2car = {car.car_id: car for car in self.fleet}
+        snapshot['cars_to_run'] = OrderedDict([(car_id, id2car[car_id]) for car_id in snapshot['cars_to_run']])
+        for name in ('running_cars', 'ended_cars'):
+            snapshot[name] = {car_id: id2car[car_id] for car_id in snapshot[name]}
+        self.restore(snapshot)
+
+    def _build_priority_cars(self):
+        for road in self.roads.values():
+            road.build_priority_cars()
 
     def _get_road2car_flows(self, cross):
         """路口内的调度的限制
@@ -96,37 +398,15 @@ class Scheduler(object):
         2. 直行优先, 左转其次, 右转最次
         3. 每条道路内, 又车道优先级以及按照距离路口的距离安排行车
 
-        本方法属于偷懒的办法, 为每条道路安排好直行左转右转的道路, 同时编排号道路内行车顺序
+        每条道路内的行车顺序由 Road.build_priority_cars 在时间片开始时排好,
+        这里只为每条道路取出右侧/对面/左边道路当前优先级最高的车辆
         """
-        road2car_flows = {}  # [[当前道路], [右侧道路], [对面道路], [左边道路]] 视为一个 car_flow
+        road2car_flows = {}  # (当前道路, 右侧道路的头车, 对面道路的头车, 左边道路的头车) 视为一个 car_flow
         roads = list(cross.connected_roads.values())
+        roads += [None] * (4 - len(roads))
+        heads = [road.get_priority_head() if road else None for road in roads]
         for i, road_id in enumerate(cross.connected_roads.keys()):
-            cars = OrderedDict([
-                (roads[i%4].lanes[lane].positions[pos].car_id, roads[i%4].lanes[lane].positions[pos])
-                for pos in range(roads[i%4].length)
-                for lane in range(len(roads[i%4].lanes))
-                if roads[i%4].lanes[lane].positions[pos] and roads[i%4].lanes[lane].positions[pos].state != CAR_STOP
-            ]) if roads[i%4] else {}
-            right_cars = OrderedDict([
-                (roads[(i+1)%4].lanes[lane].positions[pos].car_id, roads[(i+1)%4].lanes[lane].positions[pos])
-                for pos in range(roads[(i+1)%4].length)
-                for lane in range(len(roads[(i+1)%4].lanes))
-                if roads[(i+1)%4].lanes[lane].positions[pos] and roads[(i+1)%4].lanes[lane].positions[pos].state != CAR_STOP
-            ]) if roads[(i+1)%4] else {}
-            opposite_cars = OrderedDict([
-                (roads[(i+2)%4].lanes[lane].positions[pos].car_id, roads[(i+2)%4].lanes[lane].positions[pos])
-                for pos in range(roads[(i+2)%4].length)
-                for lane in range(len(roads[(i+2)%4].lanes))
-                if roads[(i+2)%4].lanes[lane].positions[pos] and roads[(i+2)%4].lanes[lane].positions[pos].state != CAR_STOP
-            ]) if roads[(i+2)%4] else {}
-            left_cars = OrderedDict([
-                (roads[(i+3)%4].lanes[lane].positions[pos].car_id, roads[(i+3)%4].lanes[lane].positions[pos])
-                for pos in range(roads[(i+3)%4].length)
-                for lane in range(len(roads[(i+3)%4].lanes))
-                if roads[(i+3)%4].lanes[lane].positions[pos] and roads[(i+3)%4].lanes[lane].positions[pos].state != CAR_STOP
-            ]) if roads[(i+3)%4] else {}
-
-            road2car_flows[road_id] = [cars, right_cars, opposite_cars, left_cars]
+            road2car_flows[road_id] = (roads[i], heads[(i+1)%4], heads[(i+2)%4], heads[(i+3)%4])
 
         return road2car_flows
 
@@ -136,79 +416,143 @@ class Scheduler(object):
                 for lane in road.lanes:
                     self._schedule_cars_move_on_the_same_way(OrderedDict([(car.car_id, car) for car in lane.positions if car]))
 
+    def _schedule_crosses_1(self, crosses):
+        """_schedule_cross_1 的批量版本, 一次计算所有路口所有车道的第一步调度.
+
+        车道内的移动由 utc.kernel 一次算完; 到达终点 (更新路权) 与规划路线 (读取路权) 依赖路网,
+        按原先 路口 -> 道路 -> 车道 -> 车辆 的顺序逐条车道补上, 因此结果与逐个路口调度完全一致.
+        """
+        road_lanes = [
+            (road, lane)
+            for cross in crosses
+            for road in cross.connected_roads.values() if road
+            for lane in road.lanes
+        ]
+        lane_cars = [[lane.positions[pos] for pos in lane.positions.occupied] for _, lane in road_lanes]
+        num_cols = max([len(cars) for cars in lane_cars] or [0])
+        if num_cols == 0:
+            return
+
+        car_ids = np.full((len(road_lanes), num_cols), -1, dtype=np.int64)
+        for i, cars in enumerate(lane_cars):
+            car_ids[i, :len(cars)] = [car.car_id for car in cars]
+        index = np.where(car_ids >= 0, car_ids, 0)
+        fleet = self.fleet
+        new_positions, new_speeds, new_states, moved, ended, waiting = move_cars_on_the_same_way(
+            car_ids,
+            fleet.on_position[index],
+            fleet.current_speed[index],
+            fleet.highest_speed[index],
+            fleet.state[index],
+            fleet.start_cross_id[index] == fleet.end_cross_id[index],
+            np.array([lane.speed for _, lane in road_lanes], dtype=np.int32))
+
+        for i, (road, lane) in enumerate(road_lanes):
+            cars = lane_cars[i]
+            n = len(cars)
+            if n == 0:
+                continue
+            ids = car_ids[i, :n]
+
+            # 1.2.1 到达目的地, 这些车一定排在车道的最前面, 路权按此刻的车道情况更新
+            for k in np.flatnonzero(ended[i, :n]):
+                car = cars[k]
+                lane.positions[car.on_position] = None
+                car.state = CAR_END
+                self.ended_cars[car.car_id] = self.running_cars.pop(car.car_id)
+                self._update_road_weight(road)
+
+            # 车辆前进, 从路口开始依次移动, 目标位置一定已经空出
+            for k in np.flatnonzero(moved[i, :n]):
+                car = cars[k]
+                lane.positions[car.on_position] = None
+                lane.positions[int(new_positions[i, k])] = car
+
+            stays = ~ended[i, :n]
+            fleet.on_position[ids] = new_positions[i, :n]
+            fleet.current_speed[ids] = new_speeds[i, :n]
+            fleet.state[ids[stays]] = new_states[i, :n][stays]
+            self.waiting_cars.difference_update(ids[stays & (new_states[i, :n] == CAR_STOP)].tolist())
+            if road.depends_on_last_car_state():
+                road.invalidate_state()
+
+            # 等待过路口的车辆规划路线
+            for k in np.flatnonzero(waiting[i, :n]):
+                car = cars[k]
+                if not car.pass_intention:
+                    self._make_plan_for_running_car(car)
+
     def _schedule_cross_2(self, cross):
         road2car_flows = self._get_road2car_flows(cross)
         # num_rest_cars 用以观察记录当前是否已经不存在可调度的车辆了, 也许路口内车辆在等待其他路口的车辆, 因此跳过
-        num_rest_cars = len([car.car_id for car in self.running_cars.values() if car.state != CAR_STOP])
+        num_rest_cars = len(self.waiting_cars)
         while True:
-            for road_id in sorted(cross.connected_roads.keys(), key=lambda k: int(k)):
+            for road_id in sorted(cross.connected_roads.keys()):
                 if road_id in (-1, -2):
                     continue
-                cars, right_cars, opposite_cars, left_cars = road2car_flows[road_id]
+                road, right_car, opposite_car, left_car = road2car_flows[road_id]
+                if not road:
+                    continue
                 # car_flows = cars + right_cars + opposite_cars + left_cars
                 # 名义上的过路口车辆调度, 但车辆可能过不了路口
-                self._schedule_cars_pass_cross(cars, right_cars, opposite_cars, left_cars)
+                self._schedule_cars_pass_cross(road.iter_priority_cars(), right_car, opposite_car, left_car)
                 # cars = self._schedule_cars_pass_cross(cars, right_cars, opposite_cars, left_cars)
                 # if cars:
                 #     self.running_cars.update(cars)
                 # logger.info('\t\t剩余待调度车辆: {}'.format(len([car.car_id for car in self.running_cars if car.state != CAR_STOP])))
                 
             # 条件成立, 路口内有车辆被调度, 也许还有车辆因为这一次调度可以走了, 因此不跳出 while 循环
-            new_num_rest_cars = len([car.car_id for car in self.running_cars.values() if car.state != CAR_STOP])
+            new_num_rest_cars = len(self.waiting_cars)
             if new_num_rest_cars < num_rest_cars:
                 num_rest_cars = new_num_rest_cars
             else:
-                self._check_positions(self.running_cars)  # 不放心可以再检查一遍
                 break
 
+    def _find_active_crosses(self):
+        """找出仍有待调度车辆驶入的路口, 按路口 id 升序排列
+
+        只有进入路口方向的道路上还有等待调度的车辆, 路口才需要再次调度;
+        出路口方向的道路腾出空间, 也只对这些路口有意义.
+        车辆在一个时间片内不会从 CAR_STOP 变回等待状态, 因此其余路口的两步调度都是空操作, 可以直接跳过.
+        """
+        cross_ids = set([self.running_cars[car_id].start_cross_id for car_id in self.waiting_cars])
+        return [self.crosses[cross_id] for cross_id in sorted(cross_ids)]
+
     def _schedule_running_cars(self):
         """对每条道路上的车辆, 按照从路口开始的顺序调度"""
         if len(self.running_cars) == 0:
             return
 
+        num_rest_cars = None
         while True:
             # 除了完成调度的车辆, 只有当全部车辆转为 CAR_STOP 才意味着本次调度结束
-            if len([car for car in self.running_cars.values() if car.state!=CAR_STOP]) == 0:
+            if len(self.waiting_cars) == 0:
                 break
-
-            assert None not in self.running_cars.values()
+            # 上一轮调度没有任何车辆完成调度, 再调度也不会有进展
+            if num_rest_cars is not None and len(self.waiting_cars) >= num_rest_cars:
+                self._report_deadlock()
+            num_rest_cars = len(self.waiting_cars)
 
             # 9. 系统调度详细说明 6. 调度处理逻辑 第一步: 处理所有道路的车辆的顺序, 即让能跑的车都跑了
             # 以下处理会有一些问题, 因为车辆在 self.running_cars 中并非按照道路上的词序排列
             # self._schedule_cars_move_on_the_same_way(self.running_cars)
 
-            # with ProcessPoolExecutor() as ex:
-            # with ThreadPoolExecutor() as ex:
-            #     ex.map(self._schedule_cross_1, self.crosses.values())
-
-            # car_flows = []
-            for cross in self.crosses.values():
-                self._schedule_cross_1(cross)
-            #     for road in cross.connected_roads.values():
-            #         car_flows.append(OrderedDict([
-            #             (road.lanes[lane].positions[pos].car_id, road.lanes[lane].positions[pos])
-            #             for lane in range(len(road.lanes))
-            #             for pos in range(road.length)
-            #             if road.lanes[lane].positions[pos] # and road.lanes[lane].positions[pos].state != CAR_TO_RUN
-            #         ]) if road else {})
-            #     # self._schedule_cars_move_on_the_same_way(car_flows)
+            # 本轮只调度仍有车辆等待的路口, 依然按路口 id 升序
+            active_crosses = self._find_active_crosses()
 
-            # with ProcessPoolExecutor() as ex:
-            #     car_flows = ex.map(self._schedule_cars_move_on_the_same_way, car_flows)
-
-            # for car_flow in car_flows:
-            #     if car_flow: self.running_cars.update(car_flow)
+            if self.vectorized_phase1:
+                self._schedule_crosses_1(active_crosses)
+            else:
+                for cross in active_crosses:
+                    self._schedule_cross_1(cross)
 
             # 经过以上调度, 路上只有两种状态的车辆, 已完成调度的 CAT_STOP 或等待调度的 CAR_RUNNING
-            assert not [car for car in self.running_cars.values() if car.state == CAR_TO_RUN]
+            assert not [car_id for car_id in self.waiting_cars if self.running_cars[car_id].state == CAR_TO_RUN]
 
             # logger.info('第{t}个时间片调度\t完成路网中所有可直接调度车辆, 剩余{n}辆车等待调度'.format(
             #     t=self.current_time, n=len([car.car_id for car in self.running_cars if car.state != CAR_STOP])))
-            
-            # with ThreadPoolExecutor() as ex:
-            #     ex.map(self._schedule_cross_2, self.crosses.values())
 
-            for cross in self.crosses.values():
+            for cross in active_crosses:
                 self._schedule_cross_2(cross)
             #     road2car_flows = self._get_road2car_flows(cross)
             #     # num_rest_cars 用以观察记录当前是否已经不存在可调度的车辆了, 也许路口内车辆在等待其他路口的车辆, 因此跳过
@@ -238,17 +582,20 @@ class Scheduler(object):
         # 4. 路网要变
             # 1. 最重要的, 对应道路的权重要变 (在对整条道路进行调度后调整)
 
-    def _schedule_cars_pass_cross(self, cars, right_cars, opposite_cars, left_cars):
-        """偷懒起见, 很多和 _schedule_cars_move_on_the_same_way 有大量重复代码"""
-        for car in cars.values():
+    def _schedule_cars_pass_cross(self, cars, right_car, opposite_car, left_car):
+        """偷懒起见, 很多和 _schedule_cars_move_on_the_same_way 有大量重复代码
+
+        right_car/opposite_car/left_car 为其他方向道路上优先级最高的等待调度车辆, 没有则为 None
+        """
+        for car in cars:
             assert car
             if car.state == CAR_STOP or car.state == CAR_END:
                 continue
 
             cross = self.crosses.get(car.start_cross_id)
-            road = self.roads.get(car.on_road)
-            lane = road.lanes[int(car.on_lane[car.on_lane.find('@')+1:])-1]
-            road_to_turn = self.roads.get(car.road_to_turn)
+            road = car.on_road
+            lane = car.on_lane
+            road_to_turn = car.road_to_turn
 
             if lane.find_previous_car_position(car.on_position) is None:
                 previous_car = None
@@ -318,15 +665,15 @@ class Scheduler(object):
                         car.state = CAR_STOP
                         continue
                     elif car.pass_intention == 'turn_left':
-                        if right_cars and list(right_cars.values())[0].pass_intention == 'go_strainght':
+                        if right_car and right_car.pass_intention == 'go_strainght':
                             return
                         self._car_pass_cross(car, road_to_turn)
                         car.state = CAR_STOP
                         continue
                     elif car.pass_intention == 'turn_right':
-                        if left_cars and list(left_cars.values())[0].pass_intention == 'go_straight':
+                        if left_car and left_car.pass_intention == 'go_straight':
                             return
-                        if opposite_cars and list(opposite_cars.values())[0].pass_intention == 'turn_left':
+                        if opposite_car and opposite_car.pass_intention == 'turn_left':
                             return
                         self._car_pass_cross(car, road_to_turn)
                         car.state = CAR_STOP
@@ -377,8 +724,8 @@ class Scheduler(object):
             if car.state == CAR_STOP or car.state == CAR_END:
                 continue
 
-            road = self.roads.get(car.on_road)
-            lane = road.lanes[int(car.on_lane[car.on_lane.find('@')+1:])-1]
+            road = car.on_road
+            lane = car.on_lane
 
             if lane.find_previous_car_position(car.on_position) is None:
                 previous_car = None
@@ -452,8 +799,7 @@ class Scheduler(object):
 
     def _car_pass_cross(self, car, road_to_turn):
         lane_to_turn = road_to_turn.allocate_lane()
-        source_road = self.roads.get(car.on_road)
-        source_lane = source_road.lanes[int(car.on_lane[car.on_lane.find('@')+1:])-1]
+        source_lane = car.on_lane
 
         # 可能无法获得车道, 无法通过路口
         if not lane_to_turn:
@@ -515,10 +861,9 @@ class Scheduler(object):
             lane_to_turn.positions[lane_to_turn.find_last_drivein_position()] = car
 
         car.start_cross_id = road_to_turn.end_cross_id
-        car.passed_roads.append(road_to_turn.road_id)
-        car.passed_crosses.append(road_to_turn.start_cross_id)
-        car.on_road = road_to_turn.road_id
-        car.on_lane = lane_to_turn.lane_id
+        self.fleet.append_route(car.car_id, road_to_turn.road_id, road_to_turn.start_cross_id)
+        car.on_road = road_to_turn
+        car.on_lane = lane_to_turn
         assert lane_to_turn.positions[car.on_position] is car
         car.state = CAR_STOP
 
@@ -556,78 +901,49 @@ class Scheduler(object):
             next_car = lane.positions[lane.find_next_car_position(car.on_position)]
             next_car.current_speed = min(car.current_speed, next_car.highest_speed)
     
+    def _get_road_weight(self, road):
+        return self.roadnet[road.start_cross_id][road.end_cross_id]['weight']
+
     def _update_road_weight(self, road):
         lane = road.allocate_lane()
         if lane:
-            self.roadnet[road.start_cross_id][road.end_cross_id]['weight'] = \
-                road.length / lane.get_last_car_current_speed()
+            weight = road.length / lane.get_last_car_current_speed()
         else:
-            self.roadnet[road.start_cross_id][road.end_cross_id]['weight'] = 1000
+            weight = 1000
+        edge = self.roadnet[road.start_cross_id][road.end_cross_id]
+        if edge['weight'] != weight:
+            self.shortest_paths.on_weight_change(road.start_cross_id, road.end_cross_id, edge['weight'], weight)
+            edge['weight'] = weight
+            self.weight_epoch += 1
+            self.edge_versions[(road.start_cross_id, road.end_cross_id)] += 1
+
+    def _get_cross_state_counts(self, cross):
+        counts = self.cross_state_counts.get(cross.cross_id)
+        if counts is None:
+            road_states = [road.get_current_state() for road in cross.connected_roads.values() if road]
+            counts = (len(road_states), road_states.count(BLOCKED), road_states.count(DRIVEIN_ABLE))
+            self.cross_state_counts[cross.cross_id] = counts
+        return counts
 
     def get_cross_states_where_car_is(self, car):
+        """除车辆所在道路以外, 路口其他驶入道路的汇总状态"""
         cross = self.crosses.get(car.start_cross_id)
-        road_states = []
+        num_roads, num_blocked, num_drivein_able = self._get_cross_state_counts(cross)
 
-        for road in cross.connected_roads.values():
-            if not road:
-                continue
-            if road.road_id == car.on_road:
-                continue
-            road_states.append(road.get_current_state())
-        
-        if all([state == BLOCKED for state in road_states]):
+        road = car.on_road
+        if road is not None and cross.connected_roads.get(road.base_road_id) is road:
+            state = road.get_current_state()
+            num_roads -= 1
+            num_blocked -= state == BLOCKED
+            num_drivein_able -= state == DRIVEIN_ABLE
+
+        if num_blocked == num_roads:
             return BLOCKED
-        elif DRIVEIN_ABLE in road_states:
+        elif num_drivein_able > 0:
             return DRIVEIN_ABLE
         else:
             return TO_BE_SCHEDULED
 
-    def _choose_a_road_to_turn(self, car, num_path=10):
-        """车库中的车辆上路, 为其选择一条道路"""
-        cross = self.crosses.get(car.start_cross_id)
-        neighbor_cross_ids = list(self.roadnet[cross.cross_id].keys())
-        neighbor_cross_ids.remove(car.passed_crosses[-1])
-
-        # 可选的道路, connected_rodas 记录的是进入路口的道路
-        roads = [self.cross_pair_to_road.get((cross.cross_id, neighbor_cross_id))
-                for neighbor_cross_id in neighbor_cross_ids]
-        roads = [road for road in roads
-                if car.on_road != road.road_id and road.get_current_state() != BLOCKED]
-
-        assert roads is not None
-
-        # 可选道路的尽头路口
-        cross_ids = [road.end_cross_id for road in roads]
-
-        path_and_time = []
-        for road, cross_id in zip(roads, cross_ids):
-            inner_path_and_time = []
-            for i, path in enumerate(nx.shortest_simple_paths(self.roadnet, cross_id, car.end_cross_id)):
-                if len(path_and_time) > num_path or i > 100:
-                    break
-
-                # 加上当前路口
-                path_time = self.get_path_time(path)
-                if path_time > 1000:
-                    continue
-                path_and_time.append(([cross.cross_id]+path, path_time+self.roadnet[cross.cross_id][path[0]]['weight']))
-
-            path_and_time.extend(inner_path_and_time)
-
-
-        paths, times = zip(*path_and_time)
-        index = np.random.choice(range(len(paths)), p=np.array([1/t for t in times])/sum([1/t for t in times]))
-
-        road_to_turn = self.cross_pair_to_road.get((paths[index][0], paths[index][1]))
-        lane_to_turn = road_to_turn.allocate_lane()
-
-        assert paths[index][0] == car.start_cross_id
-        assert lane_to_turn is not None
-        assert cross.road_pair2pass_way[(car.on_road[:car.on_road.find('#')], road_to_turn.road_id[:road_to_turn.road_id.find('#')])]
-
-        car.pass_intention = cross.road_pair2pass_way[(car.on_road[:car.on_road.find('#')], road_to_turn.road_id[:road_to_turn.road_id.find('#')])]
-        car.road_to_turn = road_to_turn.road_id
-
     def _schedule_cars_to_run(self):
         # step1, 计算当前路网的容量
         #        1. 汇总每条道路的容量
@@ -662,6 +978,10 @@ class Scheduler(object):
             # if self.get_current_roadnet_capacity() < self.block_roadnet_capacity or self.num_cars_on_road < len(self.running_cars):
             if self.get_current_roadnet_capacity() < self.block_roadnet_capacity:
                 break
+            # 探索路线很慢, 每辆车上路前都看一眼截止时间, 来不及了就把剩下的车留给 _finish_without_simulation
+            self._update_routing_mode()
+            if self.routing_mode == ROUTING_FALLBACK:
+                break
 
             if car.planned_departure_time > self.current_time:
                 continue
@@ -670,7 +990,8 @@ class Scheduler(object):
             self._make_plan_for_car_to_run(car)
 
             # TODO: 车辆所在路口的局部容量
-            road_to_run = self._choose_a_road_to_run(car)
+            road_to_run = self._choose_a_road_to_run(
+                car, prob4ideal_path=self.prob4ideal_path)
 
             if not road_to_run or road_to_run.get_current_state() != DRIVEIN_ABLE:
                 logger.info('第{t}个时间片调度\t没有为编号为{car_id}的车辆找到合适的出发道路或道路阻塞, 暂缓出发'.format(
@@ -714,27 +1035,27 @@ class Scheduler(object):
 
             car.start_cross_id = road_to_run.end_cross_id
             car.departure_time = self.current_time
-            car.passed_roads.append(road_to_run.road_id)
-            car.passed_crosses.append(road_to_run.start_cross_id)
-            car.on_road = road_to_run.road_id
-            car.on_lane = lane.lane_id
+            self.fleet.append_route(car.car_id, road_to_run.road_id, road_to_run.start_cross_id)
+            car.on_road = road_to_run
+            car.on_lane = lane
             assert lane.positions[car.on_position] is car
 
-            # 上路的车辆加入 running_cars
+            # 上路的车辆加入 running_cars, 此后车辆状态的变更都会同步到 waiting_cars
             self.running_cars[car.car_id] = self.cars_to_run.pop(car.car_id)
+            self._on_car_state_change(car, car.state)
             assert car.car_id in self.running_cars
 
             # 更新道路的权重, 可能新上路的车只能开到车道的最末位, 这时候车道相当于直接报废了, 此时无法再次获得车道信息
-            relane = road_to_run.allocate_lane()
-            if relane:
-                self.roadnet[road_to_run.start_cross_id][road_to_run.end_cross_id]['weight'] = \
-                    road_to_run.length / relane.get_last_car_current_speed()
-            else:
-                self.roadnet[road_to_run.start_cross_id][road_to_run.end_cross_id]['weight'] = 1000
+            self._update_road_weight(road_to_run)
+
+        # 没能上路的车辆放回发车索引, 下一个时间片继续尝试
+        for car in current_cars_to_run:
+            if car.car_id in self.cars_to_run:
+                heapq.heappush(self.deferred_cars, car.car_id)
         logger.info('第{t}个时间片调度\t上路车辆调度完成'.format(t=self.current_time))
 
     def get_current_roadnet_capacity(self):
-        return sum([road.get_current_capacity() for road in self.roads.values()])
+        return self.current_roadnet_capacity
 
     def _arrange_cars_to_run(self):
         """根据当前路况, 重新编排发车顺序"""
@@ -743,40 +1064,62 @@ class Scheduler(object):
         # TODO: 更复杂的方法是对于后面的道路, 估计到达时间, 然后计算那个时候的条件
         # TODO: weight=func() 动态地计算每条路上的 weight, 是个精细活.
         for car in self.cars_to_run.values():
+            # 构造时就可能耗尽时间: 来不及了就不再规划, 第一个时间片即转入 _finish_without_simulation
+            self._update_routing_mode()
+            if self.routing_mode == ROUTING_FALLBACK:
+                break
             self._make_plan_for_car_to_run(car)
 
         # self.cars_to_run = OrderedDict(sorted(self.cars_to_run.items(), key=lambda car: int(car[0])))
-        self.cars_to_run = OrderedDict(sorted(self.cars_to_run.items(), key=lambda car: car[1].ideal_arrival_time or int(car[0])))
+        self.cars_to_run = OrderedDict(sorted(self.cars_to_run.items(), key=lambda car: car[1].ideal_arrival_time or car[0]))
 
     def _make_plan_for_running_car(self, car):
-        for path in nx.shortest_simple_paths(self.roadnet,
-                                             car.start_cross_id,
-                                             car.end_cross_id,
-                                             weight='weight'):
-            if len(path) == 1:
-                return
-            if path[1] == car.passed_crosses[-1]:
-                continue
-            # 找到第一条不是掉头的路
-            car.ideal_path = path
-            break
-        car.ideal_time = self.get_path_time(car.ideal_path)
+        if car.start_cross_id == car.end_cross_id:
+            return
+        passed_crosses = car.passed_crosses
+        key = (car.start_cross_id, car.end_cross_id, passed_crosses[-1])
+        # 缓存的路线绕回车辆走过的路口时不复用, 否则各自过时的条目连起来会让车辆兜圈子
+        cached = self.route_cache.get(key, self.roadnet, self.weight_epoch, self.edge_versions,
+                                     avoid=passed_crosses)
+        if cached is not None:
+            car.ideal_path, car.ideal_time = cached
+        else:
+            path = None
+            if self.routing_mode != ROUTING_EXPLORE:
+                # 找不到不掉头的缓存路线时 (None), 仍需逐条探索
+                path = self._get_cached_path(car.start_cross_id, car.end_cross_id, passed_crosses[-1])
+            if path is None:
+                try:
+                    path = self.turn_graph.get_path(car.on_road, car.end_cross_id)
+                except nx.NetworkXNoPath:  # 不掉头到不了终点, 沿用原来的路线
+                    pass
+            if path is not None:
+                car.ideal_path = path
+                car.ideal_time = self.get_path_time(path)
+                self.route_cache.put(key, path, car.ideal_time, self.weight_epoch, self.edge_versions)
+            else:
+                car.ideal_time = self.get_path_time(car.ideal_path)
 
         road_to_turn = self.cross_pair_to_road.get((car.ideal_path[0], car.ideal_path[1]))
         cross = self.crosses.get(car.start_cross_id)
-        assert cross.road_pair2pass_way[(car.on_road[:car.on_road.find('#')], road_to_turn.road_id[:road_to_turn.road_id.find('#')])]
-        car.pass_intention = cross.road_pair2pass_way[(car.on_road[:car.on_road.find('#')], road_to_turn.road_id[:road_to_turn.road_id.find('#')])]
-        car.road_to_turn = road_to_turn.road_id
+        pass_way = cross.get_pass_way(car.on_road, road_to_turn)
+        assert pass_way
+        car.pass_intention = pass_way
+        car.road_to_turn = road_to_turn
     
     def _make_plan_for_car_to_run(self, car):
-        car.ideal_path = nx.dijkstra_path(self.roadnet,
-                                          car.start_cross_id,
-                                          car.end_cross_id,
-                                          weight='weight')
-        car.ideal_time = self.get_path_time(car.ideal_path)
+        """上路前的路线由终点的最短路径树读出, 只需 O(路线长度), 比 _get_cached_path 还便宜,
+        所以不随 routing_mode 降级; ROUTING_CACHED 只改变路上车辆的路线规划"""
+        car.ideal_path = self.shortest_paths.get_path(car.start_cross_id, car.end_cross_id)
+        car.ideal_time = self.shortest_paths.get_time(car.start_cross_id, car.end_cross_id)
         car.ideal_arrival_time = max(car.planned_departure_time, self.current_time) + car.ideal_time
 
 
+    def close(self):
+        """结束全源最短路表的后台线程, 调度结束后调用"""
+        if self.route_table is not None:
+            self.route_table.close()
+
     def get_path_time(self, path):
         return sum([
             self.roadnet[s][e]['weight']
@@ -784,54 +1127,54 @@ class Scheduler(object):
         ])
     
     def _find_cars_to_run(self, k=None):
-        """当前时间已经到了或者过了车辆的计划出发时间, 车辆可出发"""
-        current_cars_to_run = [car for car in self.cars_to_run.values() if car.planned_departure_time <= self.current_time]
-        if k:
-            return sorted(current_cars_to_run, key=lambda c: int(c.car_id))[:k]
-        else:
-            return current_cars_to_run
+        """当前时间已经到了或者过了车辆的计划出发时间, 车辆可出发.
 
-    def _choose_a_road_to_run(self, car, num_path=10, prob4ideal_path=0.5):
-        """车库中的车辆上路, 为其选择一条道路"""
-        ideal_path = car.ideal_path
-        shortest_simple_paths = nx.shortest_simple_paths(self.roadnet, car.start_cross_id, car.end_cross_id)
-        path_and_time = []  # 除最优路径以外的其他可用路径的耗时
-        for i, path in enumerate(shortest_simple_paths):
-            if path == ideal_path:
-                continue
-            # 限时要求, 仅探索有限的路线
-            if len(path_and_time) > num_path or i > 100:
-                break
+        从发车索引中取出 id 最小的 k 辆可出发车辆, 只触及真正可以出发的车辆;
+        取出的车辆如果没能上路, 由调用方放回 deferred_cars.
+        """
+        while self.departure_queue and self.departure_queue[0][0] <= self.current_time:
+            _, car_id = heapq.heappop(self.departure_queue)
+            heapq.heappush(self.deferred_cars, car_id)
 
-            # step1: 根据路口信息, 获得道路信息
-            # TODO: 不止考虑当前与当前路口相连的道路的封锁情况
-            if self.cross_pair_to_road.get((path[0], path[1])).get_current_state() == BLOCKED:
-                continue
+        current_cars_to_run = []
+        while self.deferred_cars and (not k or len(current_cars_to_run) < k):
+            current_cars_to_run.append(self.cars_to_run[heapq.heappop(self.deferred_cars)])
+        return current_cars_to_run
 
-            path_time = self.get_path_time(path)
-            # if path_time > 1000:
-            #     continue
-            path_and_time.append((path, path_time))
+    def _choose_a_road_to_run(self, car, prob4ideal_path=0.5):
+        """车库中的车辆上路, 为其选择一条道路.
+
+        除最优路线的第一条道路外, 起点路口驶出的其他未封锁的道路都是备选, 耗时为走这条道路再沿最短路线到终点的耗时
+        (见 utc.routing.DestinationTrees.get_first_hops), 以耗时的倒数为权随机选择.
+        """
+        ideal_path = car.ideal_path
+        ideal_road = self.cross_pair_to_road.get((ideal_path[0], ideal_path[1]))
+        if self.routing_mode != ROUTING_EXPLORE:
+            # 不再探索其他路线, 最优路线的第一条道路被封锁就暂缓出发
+            return None if ideal_road.get_current_state() == BLOCKED else ideal_road
+        road_and_time = []  # 除最优道路以外的其他可用道路的耗时
+        for cross_id, path_time in self.shortest_paths.get_first_hops(car.start_cross_id, car.end_cross_id):
+            road = self.cross_pair_to_road.get((car.start_cross_id, cross_id))
+            if road is ideal_road or road.get_current_state() == BLOCKED:
+                continue
+            road_and_time.append((road, path_time))
+        road_and_time = sorted(road_and_time, key=lambda rt: rt[1])
 
-        # 遍历所有可能路径未发现可走路线的, 车辆不上路
-        if not path_and_time \
-           and self.cross_pair_to_road.get((ideal_path[0], ideal_path[1])).get_current_state() == BLOCKED:
+        # 没有其他道路可走, 最优道路也被封锁的, 车辆不上路
+        if not road_and_time and ideal_road.get_current_state() == BLOCKED:
             return None
 
-        # 只有最优路径可走的情况
-        if not path_and_time:
-            return self.cross_pair_to_road.get((ideal_path[0], ideal_path[1]))
+        # 只有最优道路可走的情况
+        if not road_and_time:
+            return ideal_road
 
-        paths, times = zip(*path_and_time)
-        if self.cross_pair_to_road.get((ideal_path[0], ideal_path[1])).get_current_state() == BLOCKED:
-            # 最优路径不可走
-            path = paths[np.random.choice(range(len(paths)), p=np.array([1/t for t in times])/sum([1/t for t in times]))]
-            return self.cross_pair_to_road.get((path[0], path[1]))
+        roads, times = zip(*road_and_time)
+        if ideal_road.get_current_state() == BLOCKED:
+            # 最优道路不可走
+            return roads[np.random.choice(range(len(roads)), p=np.array([1/t for t in times])/sum([1/t for t in times]))]
         else:
-            # 最优路径可走的情况下, 以预设概率走最优路径
+            # 最优道路可走的情况下, 以预设概率走最优道路
             if random.random() < prob4ideal_path:
-                return self.cross_pair_to_road.get((ideal_path[0], ideal_path[1]))
+                return ideal_road
             else:
-                # path = np.random.choice(paths, p=np.array([1/t for t in times])/sum([1/t for t in times]))
-                path = paths[np.random.choice(range(len(paths)), p=np.array([1/t for t in times])/sum([1/t for t in times]))]
-                return self.cross_pair_to_road.get((path[0], path[1]))
\ No newline at end of file
+                return roads[np.random.choice(range(len(roads)), p=np.array([1/t for t in times])/sum([1/t for t in times]))]
@@ -0,0 +1,180 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+from utc.compiled import load_compiled_map
+from utc.loader import load_map, write_answer
+from utc.replay import replay
+from utc.scheduler import DeadlockError, Scheduler
+
+# 可调的 Scheduler 参数及其取值的类型
+KNOBS = {
+    'capacity_threshold': float,
+    'num_cars_on_road': int,
+    'prob4ideal_path': float,
+    'route_table_interval': int,  # 不在 DEFAULT_GRID 中, 默认不用全源最短路表
+}
+DEFAULT_GRID = {
+    'capacity_threshold': [0.3, 0.5, 0.7],
+    'num_cars_on_road': [256, 1024],
+    'prob4ideal_path': [0.3, 0.5, 0.7],
+}
+
+# 已完成且按官方规则回放无误的答案中最短的调度时间, 所有工作进程共享, 由 _init_worker 设置
+_best_ticks = None
+
+
+def _init_worker(best_ticks):
+    global _best_ticks
+    _best_ticks = best_ticks
+
+
+def make_configs(grid, samples=None, seed=0):
+    """网格中的全部参数组合; 指定 samples 时随机抽取其中 samples 组 (随机搜索)"""
+    names = sorted(grid)
+    configs = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+    if samples is not None and samples < len(configs):
+        configs = random.Random(seed).sample(configs, samples)
+    return configs
+
+
+def run_config(map_paths, config, answer_path, max_ticks=None, max_seconds=None, seed=0, cache_dir=None,
+                best_ticks=None):
+    """按一组参数完整调度一次, 返回 (状态, 时间片数).
+
+    状态为 finished (答案写入 answer_path), pruned (时间片数已不少于 best_ticks, 即当前最好的答案的调度时间,
+    不太可能更好), tick_limit, timeout, deadlock 或 error (调度器的其他异常).
+    best_ticks 为 multiprocessing.Value, 为 None 时不剪枝.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    start_time = time.time()
+    cars, crosses, roads, car_indexer, road_indexer = load_map(*map_paths, cache_dir=cache_dir)
+    scheduler = Scheduler(crosses, roads, cars, **config)
+    try:
+        while scheduler.cars_to_run or scheduler.running_cars:
+            if best_ticks is not None and scheduler.current_time >= best_ticks.value:
+                return 'pruned', scheduler.current_time
+            if max_ticks is not None and scheduler.current_time >= max_ticks:
+                return 'tick_limit', scheduler.current_time
+            if max_seconds is not None and time.time() - start_time > max_seconds:
+                return 'timeout', scheduler.current_time
+            scheduler.schedule()
+    except DeadlockError:
+        return 'deadlock', scheduler.current_time
+    except RuntimeError:
+        return 'error', scheduler.current_time
+    finally:
+        scheduler.close()
+
+    write_answer(answer_path, cars, car_indexer, road_indexer)
+    return 'finished', scheduler.current_time
+
+
+def _run_task(task):
+    index, map_paths, config, out_dir, max_ticks, max_seconds, seed, cache_dir = task
+    answer_path = os.path.join(out_dir, 'answer_{}.txt'.format(index))
+    status, ticks = run_config(map_paths, config, answer_path, max_ticks, max_seconds, seed, cache_dir,
+                               best_ticks=_best_ticks)
+    result = None
+    if status == 'finished':
+        # 调度器的模拟与官方规则并不逐车一致, 排序与剪枝都以官方规则下的评分为准
+        try:
+            result = replay(*map_paths, answer_path, cache_dir=cache_dir)
+        except RuntimeError:  # 答案不合法 (见 utc.replay.ReplayMap.read_answer)
+            status = 'invalid'
+        else:
+            if result.deadlock:
+                status = 'replay_deadlock'
+            elif _best_ticks is not None:
+                with _best_ticks.get_lock():
+                    _best_ticks.value = min(_best_ticks.value, result.schedule_time)
+    return index, config, status, ticks, answer_path if status == 'finished' else None, result
+
+
+def _rank(result):
+    """finished 的按官方评分 (调度时间, 总调度时间) 排在前面, 其余的按时间片数排在后面"""
+    index, config, status, ticks, answer_path, replay_result = result
+    if status == 'finished':
+        return False, replay_result.schedule_time, replay_result.total_time, index
+    return True, ticks, 0, index
+
+
+def sweep(map_paths, configs, out_dir, num_workers=None, max_ticks=None, max_seconds=None, seed=0,
+          cache_dir=None):
+    """用进程池逐个运行参数组合, 返回按官方评分排序的结果列表, 第一个 finished 的即为最好的参数.
+
+    指定 cache_dir 时地图先编译一次, 各工作进程共享内存映射的编译结果 (见 utc.compiled).
+
+    每个结果为 (序号, 参数, 状态, 时间片数, 答案路径, utc.replay.ReplayResult).
+    状态见 run_config, 另有 invalid: 调度完成, 但答案按官方规则回放时不合法;
+    replay_deadlock: 调度完成, 但答案按官方规则回放时锁死.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if cache_dir is not None:
+        load_compiled_map(*map_paths, cache_dir=cache_dir)
+    best_ticks = multiprocessing.Value('i', 2**31 - 1)
+    tasks = [(i, map_paths, config, out_dir, max_ticks, max_seconds, seed, cache_dir)
+             for i, config in enumerate(configs)]
+    if num_workers == 1:
+        _init_worker(best_ticks)
+        try:
+            results = [_run_task(task) for task in tasks]
+        finally:
+            _init_worker(None)  # 不影响之后在本进程中直接调用 run_config
+    else:
+        with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(best_ticks,)) as pool:
+            results = list(pool.imap_unordered(_run_task, tasks))
+    return sorted(results, key=_rank)
+
+
+def parse_grid(settings):
+    """['capacity_threshold=0.3,0.5', ...] -> {'capacity_threshold': [0.3, 0.5], ...}, 未指定的参数使用 DEFAULT_GRID"""
+    grid = dict(DEFAULT_GRID)
+    for setting in settings or []:
+        name, values = setting.split('=', 1)
+        if name not in KNOBS:
+            raise RuntimeError('未知的参数{}, 可选: {}'.format(name, ', '.join(sorted(KNOBS))))
+        grid[name] = [KNOBS[name](value) for value in values.split(',')]
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='并行搜索 Scheduler 的参数')
+    parser.add_argument('car_path')
+    parser.add_argument('road_path')
+    parser.add_argument('cross_path')
+    parser.add_argument('--out', default='sweep', help='每组参数的答案写在该目录下')
+    parser.add_argument('--set', action='append', metavar='NAME=V1,V2,...',
+                        help='参数的候选值, 可多次指定, 可选: {}'.format(', '.join(sorted(KNOBS))))
+    parser.add_argument('--samples', type=int, default=None, help='随机抽取的参数组数, 默认跑完整个网格')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-ticks', type=int, default=None)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--map-cache', default=None, help='编译好的地图的缓存目录, 见 utc.compiled')
+    args = parser.parse_args()
+
+    configs = make_configs(parse_grid(args.set), args.samples, args.seed)
+    results = sweep((args.car_path, args.road_path, args.cross_path), configs, args.out,
+                    num_workers=args.workers, max_ticks=args.max_ticks,
+                    max_seconds=args.max_seconds, seed=args.seed, cache_dir=args.map_cache)
+
+    print('config\tstatus\tticks\treplay')
+    for index, config, status, ticks, answer_path, result in results:
+        print('{}\t{}\t{}\t{}'.format(config, status, ticks, result if result is not None else ''))
+    best = results[0] if results and results[0][2] == 'finished' else None
+    if best is None:
+        print('没有参数组合完成调度')
+    else:
+        print('best: {} (schedule_time={}, total_time={}) -> {}'.format(
+            best[1], best[5].schedule_time, best[5].total_time, best[4]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,9 @@
+import numpy as np
+
+# 括号与逗号都换成空格, 整个文件就是一串以空白分隔的整数
+_TABLE_DELIMITERS = str.maketrans('(),', '   ')
+
+
 def strip_parenthesis(line: str):
     return line.lstrip('(').rstrip(')')
 
@@ -11,4 +17,19 @@ def read_file_and_yield_info(fname):
             if line.startswith('#'):
                 continue
             info = [item.strip() for item in strip_parenthesis(line).split(',')]
-            yield info
\ No newline at end of file
+            yield info
+
+
+def read_table(fname):
+    """read_file_and_yield_info 的批量版本: 一次读入整个文件, 返回每行一组整数的二维 int64 数组.
+
+    跳过 # 开头的注释行与空行, 每行的字段数必须相同.
+    """
+    with open(fname) as fin:
+        lines = [line for line in fin.read().splitlines() if line.strip() and not line.lstrip().startswith('#')]
+    if not lines:
+        return np.zeros((0, 0), dtype=np.int64)
+    values = np.array('\n'.join(lines).translate(_TABLE_DELIMITERS).split(), dtype=np.int64)
+    if len(values) % len(lines):
+        raise RuntimeError('{}中每行的字段数不一致'.format(fname))
+    return values.reshape(len(lines), -1)